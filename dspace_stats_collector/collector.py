@@ -42,11 +42,26 @@ try:
 except Exception: #ImportError
    from matomooutput import MatomoFilter, MatomoOutput, MatomoBulkOutput
 
+try:
+    from .fileoutput import ArchiveOutput
+except Exception: #ImportError
+   from fileoutput import ArchiveOutput
+
+try:
+    from .outputdispatcher import OutputDispatcher, OutputChannel
+except Exception: #ImportError
+   from outputdispatcher import OutputDispatcher, OutputChannel
+
 try:
     from .counterfilter import COUNTERRobotsFilter
 except Exception: #ImportError
    from counterfilter import COUNTERRobotsFilter
 
+try:
+    from .matomospool import MatomoSpool
+except Exception: #ImportError
+   from matomospool import MatomoSpool
+
 
 DESCRIPTION = """
 Collects Usage stats from DSpace repositories.
@@ -62,7 +77,59 @@ class EventPipelineBuilder:
                 SimpleHashSessionFilter(configContext),
                 MatomoFilter(configContext)
             ],
-            MatomoOutput(configContext)) 
+            self._buildOutput(configContext),
+            batchMode=(configContext.pipelineMode == 'batch'),
+            processes=configContext.pipelineProcesses,
+            chunkSize=configContext.solrQueryRows)
+
+    def _buildOutput(self, configContext):
+
+        if configContext.outputNames == ['matomo']:
+            return MatomoOutput(configContext)
+
+        # several outputs (or one keeping its own checkpoint) are fed by a dispatcher
+        channels = []
+        for name in configContext.outputNames:
+            if name == 'matomo':
+                # matomo output saves the repository history by itself
+                channels.append(OutputChannel(name, MatomoOutput(configContext), configContext.getOutputCheckpoint(name), None, configContext.solrUniqueKey, configContext.outputQueueSize))
+                continue
+
+            if name == 'file':
+                # the archive saves its history by itself, every time the appended events are on disk
+                channels.append(OutputChannel(name, ArchiveOutput(configContext, configContext.outputHistories[name]), configContext.getOutputCheckpoint(name), None, configContext.solrUniqueKey, configContext.outputQueueSize))
+                continue
+
+            if name == 'elastic':
+                try:
+                    from .elasticoutput import ElasticsearchOutput
+                except Exception: #ImportError
+                    from elasticoutput import ElasticsearchOutput
+                output = ElasticsearchOutput(configContext)
+            else:
+                logger.error('Only implemented outputs are matomo, file and elastic. Received {}'.format(name))
+                raise NotImplementedError
+
+            channels.append(OutputChannel(name, output, configContext.getOutputCheckpoint(name), configContext.outputHistories[name], configContext.solrUniqueKey, configContext.outputQueueSize))
+
+        return OutputDispatcher(channels)
+
+
+def hasPendingWork(configContext):
+    """ True if there are solr events after the checkpoint or matomo requests waiting in the spool """
+    if configContext.matomoSpoolDir is not None and 'matomo' in configContext.outputNames:
+        spool = MatomoSpool(configContext.matomoSpoolDir)
+        try:
+            if not spool.isEmpty():
+                return True
+        finally:
+            spool.close()
+
+    try:
+        return SolrStatisticsInput(configContext).hasPendingEvents()
+    except Exception as e:
+        logger.error("Could not check for new events in solr, running anyway. Error was: %s" % e)
+        return True
 
 
 def main():
@@ -139,9 +206,14 @@ def run():
     else:
         logger.debug("Start processing: %s on: %s from date: %s" % (repoName, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), configContext.history.get_last_tracked_timestamp()))
         
-    eventPipeline = EventPipelineBuilder().build(configContext)
+    # idle runs finish here, before connecting to the db and loading the robots list
+    if configContext.idleProbe and not hasPendingWork(configContext):
+        logger.info("No new events to process for %s" % repoName)
+        configContext.close()
+        return
 
     try:    
+        eventPipeline = EventPipelineBuilder().build(configContext)
         eventPipeline.run()
 
     except MatomoOfflineException as e:
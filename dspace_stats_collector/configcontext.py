@@ -21,6 +21,15 @@ try:
     from .dspacedb5cris import DSpaceDB5Cris
     from .dspacedb5oracle import DSpaceDB5Oracle
     from .dspacedb6oracle import DSpaceDB6Oracle
+    from .lrucache import LRUCache
+    from .resourcestore import SQLiteResourceStore
+    from .resourcesnapshot import ResourceSnapshot
+    from .counterfilter import COUNTERRobotsMatcher
+    from .dspacedb import DEFAULT_RESOURCE_CACHE_SIZE
+    from .counterfilter import DEFAULT_ROBOTS_CACHE_SIZE
+    from .outputdispatcher import DEFAULT_OUTPUT_QUEUE_SIZE
+    from .solrpagesize import DEFAULT_MIN_ROWS, DEFAULT_MAX_ROWS, DEFAULT_TARGET_MILLIS, DEFAULT_MAX_PAGE_BYTES
+    from .solrgovernor import DEFAULT_MAX_BACKOFF_SECONDS
 except Exception: #ImportError
     from dspacedb4 import DSpaceDB4
     from dspacedb5 import DSpaceDB5
@@ -29,6 +38,25 @@ except Exception: #ImportError
     from dspacedb5cris import DSpaceDB5Cris
     from dspacedb5oracle import DSpaceDB5Oracle
     from dspacedb6oracle import DSpaceDB6Oracle
+    from lrucache import LRUCache
+    from resourcestore import SQLiteResourceStore
+    from resourcesnapshot import ResourceSnapshot
+    from counterfilter import COUNTERRobotsMatcher
+    from dspacedb import DEFAULT_RESOURCE_CACHE_SIZE
+    from counterfilter import DEFAULT_ROBOTS_CACHE_SIZE
+    from outputdispatcher import DEFAULT_OUTPUT_QUEUE_SIZE
+    from solrpagesize import DEFAULT_MIN_ROWS, DEFAULT_MAX_ROWS, DEFAULT_TARGET_MILLIS, DEFAULT_MAX_PAGE_BYTES
+    from solrgovernor import DEFAULT_MAX_BACKOFF_SECONDS
+
+DSPACE_DB_CLASSES = {
+    '4': DSpaceDB4,
+    '5': DSpaceDB5,
+    '6': DSpaceDB6,
+    '7': DSpaceDB7,
+    '5o': DSpaceDB5Oracle,
+    '6o': DSpaceDB6Oracle,
+    '5c': DSpaceDB5Cris
+}
 
 SAVE_DIR = os.path.expanduser('~') + "/dspace-stats-collector/var/timestamp"
 DEFAULT_INSTALL_PATH = os.path.expanduser('~') + "/dspace-stats-collector"
@@ -37,13 +65,24 @@ DEFAULT_CONFIG_PATH = DEFAULT_INSTALL_PATH + "/config"
 DEFAULT_SOLR_SERVER = "http://localhost:8080/solr"
 
 DEFAULT_SOLR_STATS_CORE_NAME = "statistics"
+DEFAULT_SOLR_UNIQUE_KEY = "uid"
+DEFAULT_SOLR_FETCH_BUFFER_PAGES = 50
+DEFAULT_SOLR_PREFETCH_PAGES = 0
 TIMESTAMP_PATTERN = "%Y-%m-%dT%H:%M:%S.%fZ"
 SOLR_QUERY_ROWS_SIZE = 500
 DEFAULT_OUPUT_LIMIT = 100
 COUNTER_ROBOTS_FILE = 'COUNTER_Robots_list.json'
 LAST_TRACKED_TIMESTAMP_HISTORY_FIELD = 'lastTrackedEventTimestamp'
+LAST_TRACKED_UID_HISTORY_FIELD = 'lastTrackedEventUid'
 DEFAULT_ANONYMIZE_IP_MASK = '255.255.255.255'
 EXPORT_FILE_NAME_BASE = 'dspace_stats_export'
+DEFAULT_ROBOTS_PREFILTER_MAX_AGENTS = 20000
+RESOURCE_STORE_FILENAME = os.path.expanduser('~') + "/dspace-stats-collector/var/cache/resources.sqlite"
+DEFAULT_RESOURCE_STORE_TTL_HOURS = 168
+RESOURCE_SNAPSHOT_DIR = os.path.expanduser('~') + "/dspace-stats-collector/var/snapshot"
+DEFAULT_RESOURCE_SNAPSHOT_MAX_AGE_HOURS = 168
+MATOMO_SPOOL_DIR = os.path.expanduser('~') + "/dspace-stats-collector/var/spool"
+ARCHIVE_DIR = os.path.expanduser('~') + "/dspace-stats-collector/var/archive"
 
 class History:
     
@@ -62,7 +101,7 @@ class History:
         except (FileNotFoundError, UnboundLocalError):
             logger.debug("History file %s does not exist. Creating one..." % self.filename)
 
-    def save_last_tracked_timestamp(self, timestamp):
+    def save_last_tracked_timestamp(self, timestamp, uid=None):
         try:
             if not os.path.exists(self.base_path):
                 os.makedirs(self.base_path)
@@ -73,6 +112,8 @@ class History:
                 timestamp_str = timestamp # Assume it's already a string in the correct format
 
             self.javaprops.set_property(LAST_TRACKED_TIMESTAMP_HISTORY_FIELD, timestamp_str)    
+            # the solr unique key of the last event disambiguates events sharing the same timestamp (solr cursor paging mode)
+            self.javaprops.set_property(LAST_TRACKED_UID_HISTORY_FIELD, uid if uid is not None else '')
             with open(self.filename, mode='w') as f:
                 self.javaprops.store(f)
             self.property_dict = self.javaprops.get_property_dict()    
@@ -80,6 +121,10 @@ class History:
             logger.debug("Could not save to history file %s" % self.filename)
             raise
 
+    def get_last_tracked_uid(self):
+        uid = self.property_dict.get(LAST_TRACKED_UID_HISTORY_FIELD, None)
+        return uid if uid else None
+
     def get_last_tracked_timestamp(self):
         timestamp_str = self.property_dict.get(LAST_TRACKED_TIMESTAMP_HISTORY_FIELD, None)
         if timestamp_str:
@@ -151,13 +196,32 @@ class ConfigurationContext:
 
         # COUNTER Robots
         self.counterRobotsFilename = ("%s/" + ConfigurationContext.counterRobotsFileName) % (commandLineArgs.config_dir)
+        self.robotsCacheSize = int(self.properties.get('counter.robots.cacheSize', DEFAULT_ROBOTS_CACHE_SIZE))
+        self._robotsMatcher = None
+
+        # Outputs fed by the collector, each one keeps its own checkpoint (matomo uses the repository history)
+        self.outputNames = [ name.strip() for name in self.properties.get('collector.outputs', 'matomo').split(',') if name.strip() ]
+        self.outputHistories = dict( (name, self.history if name == 'matomo' else History(SAVE_DIR, "{}.{}".format(repoName, name))) for name in self.outputNames )
+        self.outputQueueSize = int(self.properties.get('collector.outputs.queueSize', DEFAULT_OUTPUT_QUEUE_SIZE))
+
+        # local archive of the collected events (file output), one gzip file per month appended by every run
+        self.archiveDir = self.properties.get('collector.archive.dir', "{}/{}".format(ARCHIVE_DIR, repoName))
+
+        # a rows=0 count query checks for new events before building the pipeline
+        self.idleProbe = self.properties.get('collector.idleProbe', 'true').lower() == 'true'
+        outputCheckpoints = [ (history.get_last_tracked_timestamp(), history.get_last_tracked_uid() or '') for history in self.outputHistories.values() if history.get_last_tracked_timestamp() != None ]
 
         # Solr Query parameters -     
+        self.solrQueryInitialUid = None
+        self._resumedFromHistory = False
         if commandLineArgs.date_from:
             self.solrQueryInitialTimestamp = commandLineArgs.date_from.strftime(TIMESTAMP_PATTERN)
-        elif self.history.get_last_tracked_timestamp() != None:
-            self.solrQueryInitialTimestamp = self.history.get_last_tracked_timestamp()
-            logger.debug('Loaded initialTimestamp from history: {}'.format(self.solrQueryInitialTimestamp))
+        elif len(outputCheckpoints) > 0:
+            # start from the output that is further behind, the others skip the events they already processed
+            (self.solrQueryInitialTimestamp, initialUid) = min(outputCheckpoints)
+            self.solrQueryInitialUid = initialUid if initialUid else None
+            self._resumedFromHistory = True
+            logger.debug('Loaded initialTimestamp from history: {} uid: {}'.format(self.solrQueryInitialTimestamp, self.solrQueryInitialUid))
         else:
             logger.debug('No initial date provided, using current date.')
             self.solrQueryInitialTimestamp = date.today().strftime(TIMESTAMP_PATTERN)
@@ -169,7 +233,57 @@ class ConfigurationContext:
         else:
             self.solrQueryUntilDate = None
 
-        self.solrQueryRows= SOLR_QUERY_ROWS_SIZE
+        self.solrQueryRows = int(self.properties.get('solr.rows', SOLR_QUERY_ROWS_SIZE))
+
+        # adaptive paging: rows grow or shrink between bounds so each request takes about targetMillis
+        self.solrAdaptiveRows = self.properties.get('solr.rows.adaptive', 'false').lower() == 'true'
+        self.solrMinRows = int(self.properties.get('solr.rows.min', DEFAULT_MIN_ROWS))
+        self.solrMaxRows = int(self.properties.get('solr.rows.max', DEFAULT_MAX_ROWS))
+        self.solrTargetMillis = float(self.properties.get('solr.rows.targetMillis', DEFAULT_TARGET_MILLIS))
+        self.solrMaxPageBytes = int(self.properties.get('solr.rows.maxPageBytes', DEFAULT_MAX_PAGE_BYTES))
+
+        # paging mode: timestamp (time range queries) or cursor (solr cursorMark, needs a unique key field)
+        self.solrPagingMode = self.properties.get('solr.pagingMode', 'timestamp')
+        self.solrUniqueKey = self.properties.get('solr.uniqueKey', DEFAULT_SOLR_UNIQUE_KEY)
+
+        # optionally, empty time windows are skipped asking solr for the next event instead of looking ahead one day at a time
+        self.solrSkipGaps = self.properties.get('solr.skipGaps', 'false').lower() == 'true'
+
+        # number of concurrent time shards used to fetch ranges with a fixed until date (backfills)
+        self.solrFetchThreads = int(self.properties.get('solr.fetchThreads', 1))
+        # pages each shard can fetch ahead, later shards wait for the earlier ones to be consumed
+        self.solrFetchBufferPages = int(self.properties.get('solr.fetchThreads.bufferPages', DEFAULT_SOLR_FETCH_BUFFER_PAGES))
+
+        # solr responses parsed while they are read, pages are handed out in chunks so large pages do not need to fit in memory
+        self.solrStreaming = self.properties.get('solr.streaming', 'false').lower() == 'true'
+
+        # optionally, backfills (export command, archived cores) read the whole range from the solr /export handler
+        # when every field has docValues, falling back to paging otherwise
+        self.solrExportHandler = self.properties.get('solr.exportHandler', 'false').lower() == 'true'
+
+        # load governor: at most maxQueriesPerSecond requests to solr (in bursts of up to burst requests) and an
+        # exponential back-off while solr answers slower than qtimeThresholdMillis, 0 disables each limit
+        self.solrMaxQueriesPerSecond = float(self.properties.get('solr.governor.maxQueriesPerSecond', 0))
+        self.solrQueriesBurst = int(self.properties.get('solr.governor.burst', 1))
+        self.solrQTimeThresholdMillis = int(self.properties.get('solr.governor.qtimeThresholdMillis', 0))
+        self.solrMaxBackoffSeconds = float(self.properties.get('solr.governor.maxBackoffSeconds', DEFAULT_MAX_BACKOFF_SECONDS))
+
+        # pages read ahead from solr while the pipeline is processing the current one (0 disables prefetching)
+        self.solrPrefetchPages = int(self.properties.get('solr.prefetchPages', DEFAULT_SOLR_PREFETCH_PAGES))
+
+        # user agents pre-classification using solr facets
+        self.solrRobotsPrefilter = self.properties.get('solr.robotsPrefilter', 'false').lower() == 'true'
+        self.solrRobotsPrefilterMaxAgents = int(self.properties.get('solr.robotsPrefilter.maxAgents', DEFAULT_ROBOTS_PREFILTER_MAX_AGENTS))
+        self.solrRobotsPrefilterExclude = self.properties.get('solr.robotsPrefilter.excludeRobots', 'false').lower() == 'true'
+
+        # pipeline mode: event (filters process one event at a time) or batch (filters process whole solr pages)
+        self.pipelineMode = self.properties.get('pipeline.mode', 'event')
+
+        # processes running the cpu bound filters (1 runs every filter in this process)
+        self.pipelineProcesses = int(self.properties.get('pipeline.processes', 1))
+
+        # number of events whose resources are resolved together in one db query (default: one solr page)
+        self.dbQueryBatchSize = int(self.properties.get('dspace.db.batchSize', self.solrQueryRows))
 
 
         # check if no_limit exist in command line arguments ant then set maxEventsToSend to sys.maxsize
@@ -186,27 +300,60 @@ class ConfigurationContext:
 
         self.anonymize_ip_mask = self.properties.get('anonymize.ip_mask', DEFAULT_ANONYMIZE_IP_MASK)
 
+        # durable spool of matomo requests, the checkpoint advances once events are spooled
+        if self.properties.get('matomo.spool', 'false').lower() == 'true':
+            self.matomoSpoolDir = "{}/{}".format(MATOMO_SPOOL_DIR, repoName)
+        else:
+            self.matomoSpoolDir = None
 
-        if self.dspaceMajorVersion == '4':
-            self.db = DSpaceDB4(self.dspaceProperties['db.url'],self.dspaceProperties['db.username'],self.dspaceProperties['db.password'])
-        elif self.dspaceMajorVersion == '5':
-            self.db = DSpaceDB5(self.dspaceProperties['db.url'],self.dspaceProperties['db.username'],self.dspaceProperties['db.password'])
-        elif self.dspaceMajorVersion == '6':
-            self.db = DSpaceDB6(self.dspaceProperties['db.url'],self.dspaceProperties['db.username'],self.dspaceProperties['db.password'])
-        elif self.dspaceMajorVersion == '7':
-            self.db = DSpaceDB7(self.dspaceProperties['db.url'],self.dspaceProperties['db.username'],self.dspaceProperties['db.password'])
-        elif self.dspaceMajorVersion == '5o':
-            self.db = DSpaceDB5Oracle(self.dspaceProperties['db.url'],self.dspaceProperties['db.username'],self.dspaceProperties['db.password'])
-        elif self.dspaceMajorVersion == '6o':
-            self.db = DSpaceDB6Oracle(self.dspaceProperties['db.url'],self.dspaceProperties['db.username'],self.dspaceProperties['db.password'])
-        elif self.dspaceMajorVersion == '5c':
-            self.db = DSpaceDB5Cris(self.dspaceProperties['db.url'],self.dspaceProperties['db.username'],self.dspaceProperties['db.password'])
+
+        # snapshot mode, all resources are loaded in memory at startup and used as resource cache
+        self.resourceSnapshot = None
+        self.resourceCache = None
+        if self.properties.get('dspace.db.mode', 'query') == 'snapshot':
+            maxAgeHours = float(self.properties.get('dspace.db.snapshot.maxAgeHours', DEFAULT_RESOURCE_SNAPSHOT_MAX_AGE_HOURS))
+            self.resourceSnapshot = ResourceSnapshot("{}/{}.snapshot".format(RESOURCE_SNAPSHOT_DIR, repoName), maxAgeHours * 3600)
+            dbOptions = { 'cache': self.resourceSnapshot }
+
+            if 'dspace.db.cacheSize' in self.properties:
+                logger.warning('dspace.db.cacheSize is ignored in snapshot mode, the snapshot holds every resource')
+
+        # query mode, bounded lru cache of resources recovered from db
+        else:
+            self.resourceCache = LRUCache(int(self.properties.get('dspace.db.cacheSize', DEFAULT_RESOURCE_CACHE_SIZE)))
+            dbOptions = { 'cache': self.resourceCache }
+
+        # optional persistent resource store shared across runs, opened together with the db
+        if self.properties.get('dspace.db.persistentCache', 'false').lower() == 'true':
+            self._resourceStoreTTL = float(self.properties.get('dspace.db.persistentCache.ttlHours', DEFAULT_RESOURCE_STORE_TTL_HOURS)) * 3600
         else:
+            self._resourceStoreTTL = None
+
+        if self.dspaceMajorVersion not in DSPACE_DB_CLASSES:
             logger.error('Only implemented values for dspace.majorVersion are 4, 5 and 6. Received {}'.format(self.dspaceMajorVersion))
             raise NotImplementedError
 
+        # the db connection is opened on first use, runs without new events do not need it
+        self._dbOptions = dbOptions
+        self._db = None
+
+
 
 
+    @property
+    def db(self):
+        """ DSpace db, connected (and the resource store opened and the resource snapshot refreshed) on first use """
+        if self._db is None:
+            dbOptions = dict(self._dbOptions)
+            if self._resourceStoreTTL is not None:
+                dbOptions['store'] = SQLiteResourceStore(RESOURCE_STORE_FILENAME, self.repoName, self._resourceStoreTTL)
+
+            self._db = DSPACE_DB_CLASSES[self.dspaceMajorVersion](self.dspaceProperties['db.url'],self.dspaceProperties['db.username'],self.dspaceProperties['db.password'], **dbOptions)
+
+            if self.resourceSnapshot is not None:
+                self.resourceSnapshot.refresh(self._db)
+
+        return self._db
 
     @staticmethod
     def getPropertiesFieldPath(config_dir, repoName):
@@ -216,6 +363,9 @@ class ConfigurationContext:
     def getMatomoOutputSize(self):
         return int(self.properties['matomo.batchSize'])
 
+    def getMatomoConcurrentRequests(self):
+        return int(self.properties['matomo.concurrentRequests'])
+
     def getMatomoTokenAuth(self):
         return self.properties['matomo.token_auth']
     
@@ -225,6 +375,19 @@ class ConfigurationContext:
     def getMatomoUrl(self):
         return self.properties['matomo.trackerUrl']
 
+    def getOutputCheckpoint(self, name):
+        """ (timestamp, uid) of the last event processed by an output, None if the run does not resume from history """
+        history = self.outputHistories[name]
+        if not self._resumedFromHistory or history.get_last_tracked_timestamp() is None:
+            return None
+        return (history.get_last_tracked_timestamp(), history.get_last_tracked_uid())
+
+    def getRobotsMatcher(self):
+        """ COUNTER robots matcher, shared by the solr input and the robots filter """
+        if self._robotsMatcher is None:
+            self._robotsMatcher = COUNTERRobotsMatcher(self.counterRobotsFilename, self.robotsCacheSize)
+        return self._robotsMatcher
+
     def getSolrLimit(self):
         return int(self.properties['solr.limit'])
     
@@ -245,8 +408,16 @@ class ConfigurationContext:
 
         logger.debug("Closing resources")
        
-        ## close db connection
-        self.db.close()
+        ## nothing was opened nor resolved if the db was never used
+        if self._db is None:
+            return
+
+        ## close db connection (and the resource store)
+        self._db.close()
+
+        ## persist resources resolved in this run
+        if self.resourceSnapshot is not None:
+            self.resourceSnapshot.close()
 
         ## commit solr 
         ## self._commit_solr()
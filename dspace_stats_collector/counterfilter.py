@@ -8,20 +8,90 @@ logger = logging.getLogger()
 import json
 import re
 
-class COUNTERRobotsFilter:
+try:
+    from .lrucache import LRUCache
+except Exception: #ImportError
+    from lrucache import LRUCache
 
-    def __init__(self, configContext):
-        self.configContext = configContext
-        self.counterRobots = self._readCOUNTERRobots(configContext.counterRobotsFilename)
+DEFAULT_ROBOTS_CACHE_SIZE = 10000
+
+# escaped chars in patterns that are literal strings
+_ESCAPED_CHAR_RE = re.compile(r'\\([^0-9A-Za-z])')
+_REGEX_METACHARS = set('.^$*+?{}[]|()\\')
+
+
+class COUNTERRobotsMatcher:
+
+    """ Matches user agents against the COUNTER robots list. Patterns that are plain strings are checked with
+    substring search, the rest with their compiled regex (CPython re does not optimize a single alternation of
+    all the patterns, it is slower than the loop). Verdicts are memoized per user agent in a bounded lru cache """
+    def __init__(self, filename, cacheSize=DEFAULT_ROBOTS_CACHE_SIZE):
+        self._literals = []
+        self._regexes = []
+
+        for pattern in self._readCOUNTERRobots(filename):
+            literal = _ESCAPED_CHAR_RE.sub(r'\1', pattern)
+            if any(c in _REGEX_METACHARS for c in literal):
+                self._regexes.append(re.compile(pattern))
+            else:
+                self._literals.append(literal)
+
+        logger.debug('COUNTER robots list loaded: {} literal and {} regex patterns'.format(len(self._literals), len(self._regexes)))
+        self._verdicts = LRUCache(cacheSize)
+
+        # verdicts computed in advance (ie: for the user agents reported by solr facets), never evicted
+        self._knownVerdicts = {}
 
     def _readCOUNTERRobots(self, filename):
         with open(filename) as json_file:
             counterRobotsList = json.load(json_file)
 
-        for p in counterRobotsList:
-            p['compiled_re'] = re.compile(p['pattern'])
+        return [ p['pattern'] for p in counterRobotsList ]
+
+    def isRobot(self, userAgent):
+        if userAgent is None:
+            return True
+
+        verdict = self._knownVerdicts.get(userAgent)
+        if verdict is not None:
+            return verdict
+
+        verdict = self._verdicts.get(userAgent)
+        if verdict is None:
+            verdict = self._match(userAgent)
+            self._verdicts.put(userAgent, verdict)
+
+        return verdict
+
+    def _match(self, userAgent):
+        for literal in self._literals:
+            if literal in userAgent:
+                return True
+
+        for regex in self._regexes:
+            if regex.search(userAgent) is not None:
+                return True
+
+        return False
+
+    def classify(self, userAgents):
+        """ Computes and keeps the verdicts for a set of user agents, returns dict user agent -> is_robot """
+        verdicts = dict( (userAgent, self._match(userAgent)) for userAgent in userAgents )
+        self._knownVerdicts.update(verdicts)
+        return verdicts
 
-        return counterRobotsList
+    def getStats(self):
+        return 'precomputed: {} {}'.format(len(self._knownVerdicts), self._verdicts)
+
+
+class COUNTERRobotsFilter:
+
+    # pure cpu work, can run in a process pool (no reference to the configuration context)
+    parallelSafe = True
+
+    def __init__(self, configContext):
+        self._dspaceMajorVersion = configContext.dspaceMajorVersion
+        self.matcher = configContext.getRobotsMatcher()
 
     def run(self, events):
 
@@ -31,17 +101,12 @@ class COUNTERRobotsFilter:
             logger.debug('Event timestamp: {}'.format(event._src['time']))
 
             # temporaly accept all events from DSpace 4 and no userAgent data
-            if user_agent is None and self.configContext.dspaceMajorVersion == '4': 
+            if user_agent is None and self._dspaceMajorVersion == '4': 
                 #event.is_robot = False
                 yield event 
             else:
-                is_robot = False
-
                 # searh for robots
-                for robot in self.counterRobots:
-                    is_robot = user_agent is None or robot['compiled_re'].search(user_agent) != None
-                    if is_robot:
-                        break
+                is_robot = self.matcher.isRobot(user_agent)
 
                 logger.debug('COUNTER_FILTER:: Event: {} Agent: {} is_robot:{}'.format(event._id, user_agent, is_robot))
 
@@ -51,4 +116,25 @@ class COUNTERRobotsFilter:
                 event.is_robot = is_robot
                 yield event
 
-            
\ No newline at end of file
+        logger.debug('COUNTER_FILTER:: User agent verdict cache: {}'.format(self.matcher.getStats()))
+
+    def runBatches(self, batches):
+
+        for batch in batches:
+
+            userAgents = batch.column('userAgent')
+
+            # each distinct user agent is matched once per batch
+            verdicts = dict( (userAgent, self.matcher.isRobot(userAgent)) for userAgent in set(userAgents) )
+
+            # temporaly accept all events from DSpace 4 and no userAgent data
+            if self._dspaceMajorVersion == '4':
+                verdicts[None] = None
+
+            batch.isRobot = [ verdicts[userAgent] for userAgent in userAgents ]
+
+            logger.debug('COUNTER_FILTER:: Batch of {} events, {} distinct agents, {} robots'.format(len(batch), len(verdicts), sum(1 for r in batch.isRobot if r)))
+
+            yield batch
+
+        logger.debug('COUNTER_FILTER:: User agent verdict cache: {}'.format(self.matcher.getStats()))
@@ -9,10 +9,26 @@ import sqlalchemy
 import re
 import pandas as pd
 
+try:
+    from .lrucache import LRUCache
+except Exception: #ImportError
+    from lrucache import LRUCache
+
+# max number of ids included in a single IN (...) predicate
+DB_QUERY_MAX_IDS = 1000
+
+DEFAULT_RESOURCE_CACHE_SIZE = 50000
+
+# rows fetched per round trip while streaming the whole resource tables
+SNAPSHOT_FETCH_SIZE = 5000
+
+# marks ids not present in the cache, None is cached for ids that could not be recovered from db
+_NOT_CACHED = object()
+
 
 class DSpaceDB:
 
-    def __init__(self, jdbcUrl, username, password):
+    def __init__(self, jdbcUrl, username, password, cache=None, store=None):
         
         # Parse jdbc url
         # Postgres template: jdbc:postgresql://localhost:5432/dspace
@@ -55,7 +71,11 @@ class DSpaceDB:
             logger.exception("Could not connect to DB.")
             raise
 
-        self._dfResources = pd.DataFrame(columns=['id', 'record_title', 'handle', 'is_download', 'owning_item', 'sequence_id', 'filename']).set_index('id')
+        # resource cache: resource type and normalized id -> resource dict (or None if the id could not be recovered)
+        self._resources = cache if cache is not None else LRUCache(DEFAULT_RESOURCE_CACHE_SIZE)
+
+        # optional persistent store shared across runs, consulted before querying the db
+        self._store = store
 
 
     def getDcTitleId(self):
@@ -69,40 +89,147 @@ class DSpaceDB:
 
 
     def queryDownload(self, bitstreamId): #, owningItem):
-
-        if bitstreamId not in self._dfResources.index.values:
-            SQL = self._queryDownloadSQL.format(
-                    dcTitleId = self._dcTitleId,
-                    bitstreamId = bitstreamId
-            )
-            dfRecord = pd.read_sql(SQL, self.conn).set_index('id')
-            if len(dfRecord) != 1:
-                logger.debug('Could not recover data for bitstream {} from db'.format(bitstreamId))
-                return None
-#            if dfRecord.loc[bitstreamId, 'owning_item'] != owningItem and not(type(owningItem) == list and dfRecord.loc[bitstreamId, 'owning_item'] == owningItem[0]): # DSpace 6 logs owningItem as a 1-element array in SOLR
-#                logger.debug('Owning Item mismatch for bitstream {} from db ({}, {})'.format(bitstreamId, dfRecord.loc[bitstreamId, 'owning_item'], owningItem[0]))
-#                return None
-            logger.debug('Successfully recovered data for bitstream {} from db'.format(bitstreamId))
-            self._dfResources = self._dfResources.append(dfRecord)
-
-        return self._dfResources.loc[bitstreamId].to_dict()
+        return self.queryDownloads([bitstreamId]).get(bitstreamId)
 
     def queryItem(self, itemId):
-    
-        if itemId not in self._dfResources.index.values:
-            SQL = self._queryItemSQL.format(
-                    dcTitleId = self._dcTitleId,
-                    itemId = itemId
-            )
-            dfRecord = pd.read_sql(SQL, self.conn).set_index('id')
-            if len(dfRecord) != 1:
-                logger.debug('Could not recover data for item {} from db'.format(itemId))
-                return None
-            logger.debug('Successfully recovered data for item {} from db'.format(itemId))
-            self._dfResources = self._dfResources.append(dfRecord)
-        return self._dfResources.loc[itemId].to_dict()
+        return self.queryItems([itemId]).get(itemId)
+
+    def queryDownloads(self, bitstreamIds):
+        """ Resolves a set of bitstreams using one query for all the ids not already cached
+        :return: dict bitstreamId -> resource dict (None if it could not be recovered)
+        """
+        return self._queryResources(bitstreamIds, self._queryDownloadSQL, 'bitstreamIds', 'bitstream')
+
+    def queryItems(self, itemIds):
+        """ Resolves a set of items using one query for all the ids not already cached
+        :return: dict itemId -> resource dict (None if it could not be recovered)
+        """
+        return self._queryResources(itemIds, self._queryItemSQL, 'itemIds', 'item')
+
+    # subqueries selecting every item / bitstream id, optionally restricted to items modified since a given timestamp
+    _snapshotItemIdsSQL = "SELECT it.item_id FROM item it {modifiedSince}"
+    _snapshotBitstreamIdsSQL = """SELECT bb.bitstream_id FROM bundle2bitstream bb
+                JOIN item2bundle ib ON ib.bundle_id = bb.bundle_id
+                JOIN item it ON it.item_id = ib.item_id {modifiedSince}"""
+    _snapshotWatermarkSQL = "SELECT MAX(last_modified) AS watermark FROM item"
+
+    def getLastModified(self):
+        """ Returns the last modification timestamp of items in the db """
+        return pd.read_sql(self._snapshotWatermarkSQL, self.conn, parse_dates=['watermark']).watermark[0]
+
+    def streamResources(self, modifiedSince=None):
+        """ Generator of (cacheKey, resource dict) for every item and bitstream, or only those belonging to items
+        modified since the given timestamp. Rows are streamed using a server side cursor
+        """
+        if modifiedSince is None:
+            modifiedSinceFilter = ''
+        else:
+            modifiedSinceFilter = "WHERE it.last_modified >= TIMESTAMP '{:%Y-%m-%d %H:%M:%S}'".format(modifiedSince)
+
+        for (queryTemplate, idsParameter, idsTemplate, resourceType) in [
+                (self._queryItemSQL, 'itemIds', self._snapshotItemIdsSQL, 'item'),
+                (self._queryDownloadSQL, 'bitstreamIds', self._snapshotBitstreamIdsSQL, 'bitstream') ]:
+
+            SQL = queryTemplate.format(**{
+                    'dcTitleId': self._dcTitleId,
+                    idsParameter: idsTemplate.format(modifiedSince=modifiedSinceFilter)
+            })
+            result = self.conn.execution_options(stream_results=True).execute(sqlalchemy.text(SQL))
+            columns = list(result.keys())
+
+            n = 0
+            while True:
+                rows = result.fetchmany(SNAPSHOT_FETCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    record = dict(zip(columns, row))
+                    yield (self._cacheKey(resourceType, str(record.pop('id'))), record)
+                n += len(rows)
+
+            result.close()
+            logger.debug('Streamed {} {} rows from db'.format(n, resourceType))
+
+    def _normalizeId(self, resourceId):
+        """ Returns the id as the db reports it (DSpace < 6 uses integer ids), raises ValueError if is not valid """
+        return str(int(resourceId))
+
+    def _sqlId(self, normalizedId):
+        """ Returns the normalized id as a literal usable inside the IN (...) predicate """
+        return normalizedId
+
+    def _cacheKey(self, resourceType, normalizedId):
+        # item and bitstream ids may collide in DSpace < 6
+        return '{}:{}'.format(resourceType, normalizedId)
+
+    def _queryResources(self, resourceIds, queryTemplate, idsParameter, resourceType):
+
+        resources = {}
+        missingIds = {} # normalized id -> original ids
+
+        for resourceId in resourceIds:
+            try:
+                normalizedId = self._normalizeId(resourceId)
+            except (ValueError, TypeError, AttributeError):
+                logger.debug('Invalid {} id {}'.format(resourceType, resourceId))
+                resources[resourceId] = None
+                continue
+
+            record = self._resources.get(self._cacheKey(resourceType, normalizedId), _NOT_CACHED)
+            if record is _NOT_CACHED:
+                missingIds.setdefault(normalizedId, []).append(resourceId)
+            else:
+                resources[resourceId] = record
+
+        if self._store is not None and len(missingIds) > 0:
+            storeKeys = dict( (self._cacheKey(resourceType, normalizedId), normalizedId) for normalizedId in missingIds.keys() )
+            for (cacheKey, record) in self._store.getMany(storeKeys.keys()).items():
+                self._resources.put(cacheKey, record)
+                for resourceId in missingIds.pop(storeKeys[cacheKey]):
+                    resources[resourceId] = record
+
+        missingList = list(missingIds.keys())
+
+        # Oracle does not accept more than 1000 expressions in a list
+        for start in range(0, len(missingList), DB_QUERY_MAX_IDS):
+            chunk = missingList[start:start + DB_QUERY_MAX_IDS]
+
+            SQL = queryTemplate.format(**{
+                    'dcTitleId': self._dcTitleId,
+                    idsParameter: ', '.join(self._sqlId(normalizedId) for normalizedId in chunk)
+            })
+            rows = pd.read_sql(SQL, self.conn).to_dict('records')
+            logger.debug('Queried {} {} ids from db, {} rows returned'.format(len(chunk), resourceType, len(rows)))
+
+            # only ids with exactly one row are considered as successfully recovered
+            rowsById = {}
+            recovered = {}
+            for row in rows:
+                rowsById.setdefault(str(row.pop('id')), []).append(row)
+
+            for normalizedId in chunk:
+                idRows = rowsById.get(normalizedId, [])
+                if len(idRows) == 1:
+                    record = idRows[0]
+                    recovered[self._cacheKey(resourceType, normalizedId)] = record
+                else:
+                    logger.debug('Could not recover data for {} {} from db'.format(resourceType, normalizedId))
+                    record = None
+
+                self._resources.put(self._cacheKey(resourceType, normalizedId), record) # ids without data are cached too
+                for resourceId in missingIds[normalizedId]:
+                    resources[resourceId] = record
+
+            # only recovered resources are persisted, missing ids may become available later
+            if self._store is not None:
+                self._store.putMany(recovered)
+
+        return resources
 
     def close(self):
+        logger.debug("DSpace DB resource cache:: {}".format(self._resources))
+        if self._store is not None:
+            self._store.close()
         logger.debug("Closing dspace db connection")
         self.conn.close()
 
@@ -12,9 +12,9 @@ except Exception: #ImportError
 
 class DSpaceDB4(DSpaceDB):
 
-    def __init__(self, jdbcUrl, username, password):
+    def __init__(self, jdbcUrl, username, password, **kwargs):
 
-        DSpaceDB.__init__(self,jdbcUrl, username, password)
+        DSpaceDB.__init__(self, jdbcUrl, username, password, **kwargs)
       
         self._queryDownloadSQL = """
            SELECT C.bitstream_id as id, record_title, handle, is_download, owning_item, sequence_id, filename FROM
@@ -25,7 +25,7 @@ class DSpaceDB4(DSpaceDB):
             'owning_item' AS owning_item
             FROM metadatavalue AS mv
             RIGHT JOIN handle AS h ON mv.item_id = h.resource_id
-            WHERE mv.metadata_field_id = 64 AND h.resource_type_id = 2) AS A
+            WHERE mv.metadata_field_id = {dcTitleId} AND h.resource_type_id = 2) AS A
             JOIN
             (SELECT b.sequence_id,
             b.name AS filename,
@@ -36,7 +36,7 @@ class DSpaceDB4(DSpaceDB):
             item2bundle AS i
             WHERE bb.bitstream_id = b.bitstream_id
             AND i.bundle_id = bb.bundle_id
-            AND b.bitstream_id = 3) AS C
+            AND b.bitstream_id IN ({bitstreamIds})) AS C
             ON A.id = C.item_id;
             """
         self._queryItemSQL = """
@@ -51,7 +51,7 @@ class DSpaceDB4(DSpaceDB):
             RIGHT JOIN handle AS h ON h.resource_id = mv.item_id
             WHERE metadata_field_id = {dcTitleId}
                 AND h.resource_type_id=2
-                AND mv.item_id = {itemId};
+                AND mv.item_id IN ({itemIds});
             """
 
         self._queryTitleSQL = """
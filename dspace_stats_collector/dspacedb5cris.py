@@ -12,9 +12,9 @@ except Exception: #ImportError
 
 class DSpaceDB5Cris(DSpaceDB):
 
-    def __init__(self, jdbcUrl, username, password):
+    def __init__(self, jdbcUrl, username, password, **kwargs):
 
-        DSpaceDB.__init__(self,jdbcUrl, username, password)
+        DSpaceDB.__init__(self, jdbcUrl, username, password, **kwargs)
        
         self._queryDownloadSQL = """
             SELECT mv.resource_id AS id,
@@ -36,7 +36,7 @@ class DSpaceDB5Cris(DSpaceDB):
                 AND b.deleted = FALSE
                 AND mv2.metadata_field_id = {dcTitleId}
                 AND mv2.resource_type_id=2
-                AND mv.resource_id = {bitstreamId};
+                AND mv.resource_id IN ({bitstreamIds});
         """
 
         self._queryItemSQL = """
@@ -52,7 +52,7 @@ class DSpaceDB5Cris(DSpaceDB):
             WHERE metadata_field_id = {dcTitleId}
                 AND mv.resource_type_id=2
                 AND h.resource_type_id=2
-                AND mv.resource_id = {itemId};
+                AND mv.resource_id IN ({itemIds});
         """
 
         self._queryTitleSQL = """
@@ -5,6 +5,8 @@
 import logging
 logger = logging.getLogger()
 
+import uuid
+
 try:
     from .dspacedb import DSpaceDB
 except Exception: #ImportError
@@ -12,9 +14,9 @@ except Exception: #ImportError
 
 class DSpaceDB6(DSpaceDB):
 
-    def __init__(self, jdbcUrl, username, password):
+    def __init__(self, jdbcUrl, username, password, **kwargs):
 
-        DSpaceDB.__init__(self,jdbcUrl, username, password)
+        DSpaceDB.__init__(self, jdbcUrl, username, password, **kwargs)
 
         self._queryDownloadSQL = """
             SELECT mv.dspace_object_id::text AS id,
@@ -34,7 +36,7 @@ class DSpaceDB6(DSpaceDB):
                 AND b.sequence_id IS NOT NULL
                 AND b.deleted = FALSE
                 AND mv2.metadata_field_id = {dcTitleId}
-                AND mv.dspace_object_id = uuid('{bitstreamId}');
+                AND mv.dspace_object_id IN ({bitstreamIds});
         """
 
         self._queryItemSQL = """
@@ -49,7 +51,7 @@ class DSpaceDB6(DSpaceDB):
             RIGHT JOIN handle AS h ON h.resource_id = mv.dspace_object_id
             WHERE metadata_field_id = {dcTitleId}
                 AND h.resource_type_id=2
-                AND mv.dspace_object_id = uuid('{itemId}');
+                AND mv.dspace_object_id IN ({itemIds});
         """
       
         self._queryTitleSQL = """
@@ -64,6 +66,13 @@ class DSpaceDB6(DSpaceDB):
 
         self._dcTitleId = self.getDcTitleId()
 
+    _snapshotItemIdsSQL = "SELECT it.uuid FROM item it {modifiedSince}"
+    _snapshotBitstreamIdsSQL = """SELECT bb.bitstream_id FROM bundle2bitstream bb
+                JOIN item2bundle ib ON ib.bundle_id = bb.bundle_id
+                JOIN item it ON it.uuid = ib.item_id {modifiedSince}"""
 
+    def _normalizeId(self, resourceId):
+        return str(uuid.UUID(str(resourceId)))
 
-    
\ No newline at end of file
+    def _sqlId(self, normalizedId):
+        return "uuid('{}')".format(normalizedId)
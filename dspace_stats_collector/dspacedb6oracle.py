@@ -5,6 +5,8 @@
 import logging
 logger = logging.getLogger()
 
+import uuid
+
 try:
     from .dspacedb import DSpaceDB
 except Exception: #ImportError
@@ -12,9 +14,9 @@ except Exception: #ImportError
 
 class DSpaceDB6Oracle(DSpaceDB):
 
-    def __init__(self, jdbcUrl, username, password):
+    def __init__(self, jdbcUrl, username, password, **kwargs):
 
-        DSpaceDB.__init__(self,jdbcUrl, username, password)
+        DSpaceDB.__init__(self, jdbcUrl, username, password, **kwargs)
 
         self._queryDownloadSQL = """
             SELECT regexp_replace(lower(mv.dspace_object_id), '(........)(....)(....)(....)(.*)', '\\1-\\2-\\3-\\4-\\5') AS id,            
@@ -34,7 +36,7 @@ class DSpaceDB6Oracle(DSpaceDB):
                 AND b.sequence_id IS NOT NULL
                 AND b.deleted = 0
                 AND mv2.metadata_field_id = {dcTitleId}
-                AND mv.dspace_object_id = upper(replace('{bitstreamId}','-',''))
+                AND mv.dspace_object_id IN ({bitstreamIds})
         """
 
         self._queryItemSQL = """
@@ -49,7 +51,7 @@ class DSpaceDB6Oracle(DSpaceDB):
             INNER JOIN handle h ON h.resource_id = mv.dspace_object_id
             WHERE metadata_field_id = {dcTitleId}
                 AND h.resource_type_id=2
-                AND mv.dspace_object_id = upper(replace('{itemId}','-',''))
+                AND mv.dspace_object_id IN ({itemIds})
         """
       
         self._queryTitleSQL = """
@@ -63,4 +65,15 @@ class DSpaceDB6Oracle(DSpaceDB):
         """
 
         self._dcTitleId = self.getDcTitleId()
-    
\ No newline at end of file
+
+    _snapshotItemIdsSQL = "SELECT it.uuid FROM item it {modifiedSince}"
+    _snapshotBitstreamIdsSQL = """SELECT bb.bitstream_id FROM bundle2bitstream bb
+                JOIN item2bundle ib ON ib.bundle_id = bb.bundle_id
+                JOIN item it ON it.uuid = ib.item_id {modifiedSince}"""
+
+    def _normalizeId(self, resourceId):
+        return str(uuid.UUID(str(resourceId)))
+
+    def _sqlId(self, normalizedId):
+        # ids are stored as raw(16), compared as uppercase hex without dashes
+        return "'{}'".format(uuid.UUID(normalizedId).hex.upper())
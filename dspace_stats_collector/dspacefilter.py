@@ -5,32 +5,84 @@
 import logging
 logger = logging.getLogger()
 
+from itertools import islice
+
+DOWNLOAD_TYPE = 0
+ITEM_TYPE = 2
+
 class DSpaceDBFilter:
 
     def __init__(self, configContext):
         self._db = configContext.db
+        self._batchSize = configContext.dbQueryBatchSize
 
     def run(self, events):
 
-        for event in events:
-            resourceId = event._src['id']
+        events = iter(events)
+
+        while True:
+            # consume events in windows, resolving all the ids of each window in one query per resource type
+            window = list(islice(events, self._batchSize))
+            if len(window) == 0:
+                break
+
+            downloadIds = set( event._src['id'] for event in window if event._src['type'] == DOWNLOAD_TYPE )
+            itemIds = set( event._src['id'] for event in window if event._src['type'] == ITEM_TYPE )
+
+            downloads = self._db.queryDownloads(downloadIds) if len(downloadIds) > 0 else {}
+            items = self._db.queryItems(itemIds) if len(itemIds) > 0 else {}
+
+            logger.debug('DSPACE_DB_FILTER:: Window of {} events resolved ({} downloads, {} items)'.format(len(window), len(downloadIds), len(itemIds)))
+
+            for event in window:
+                resourceId = event._src['id']
+
+                if event._src['type'] == DOWNLOAD_TYPE: # Download
+                    event._db = downloads.get(resourceId)
+
+                elif event._src['type'] == ITEM_TYPE: # Item
+                    event._db = items.get(resourceId)
+
+                else:
+                    logger.error("Unexpected resource type {} for resource: {}".format(event._src['type'], event._src))
+                    raise ValueError
+
+                if event._db is None:
+                    logger.debug("Dropping event due db error on data recovery: {}".format(event._src))
+                    continue # Drop event if could not recover data from db
+
+                logger.debug('DSPACE_DB_FILTER:: Event: {}'.format(event._id))
+
+                yield event
+
+    def runBatches(self, batches):
+
+        for batch in batches:
+            types = batch.column('type')
+            resourceIds = batch.column('id')
+
+            downloadIds = set( resourceId for (resourceType, resourceId) in zip(types, resourceIds) if resourceType == DOWNLOAD_TYPE )
+            itemIds = set( resourceId for (resourceType, resourceId) in zip(types, resourceIds) if resourceType == ITEM_TYPE )
+
+            resources = {
+                DOWNLOAD_TYPE: self._db.queryDownloads(downloadIds) if len(downloadIds) > 0 else {},
+                ITEM_TYPE: self._db.queryItems(itemIds) if len(itemIds) > 0 else {}
+            }
 
-            if event._src['type'] == 0: # Download
-                isDownload = True
-                event._db = self._db.queryDownload(resourceId)
-               
-            elif event._src['type'] == 2: # Item
-                isDownload = False
-                event._db = self._db.queryItem(resourceId)
+            logger.debug('DSPACE_DB_FILTER:: Batch of {} events resolved ({} downloads, {} items)'.format(len(batch), len(downloadIds), len(itemIds)))
 
-            else:
-                logger.error("Unexpected resource type {} for resource: {}".format(event._src['type'], event._src))
-                raise ValueError
+            for (i, resourceType) in enumerate(types):
+                if resourceType not in resources:
+                    logger.error("Unexpected resource type {} for resource: {}".format(resourceType, batch.docs[i]))
+                    raise ValueError
 
-            if event._db is None:
-                logger.debug("Dropping event due db error on data recovery: {}".format(event._src))
-                continue # Drop event if could not recover data from db
+                batch.db[i] = resources[resourceType].get(resourceIds[i])
 
-            logger.debug('DSPACE_DB_FILTER:: Event: {}'.format(event._id))
+            # Drop events if could not recover data from db
+            recovered = [ i for (i, record) in enumerate(batch.db) if record is not None ]
+            if len(recovered) < len(batch):
+                logger.debug("Dropping {} events due db error on data recovery".format(len(batch) - len(recovered)))
+                batch = batch.select(recovered)
 
-            yield event
\ No newline at end of file
+            if len(batch) > 0:
+                yield batch
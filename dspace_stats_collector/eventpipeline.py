@@ -7,28 +7,167 @@ logger = logging.getLogger()
 
 import json
 import traceback
+import collections
+import multiprocessing
+import random
 
-from itertools import tee
+from itertools import islice
+
+try:
+    from .outputdispatcher import OutputDispatcher, OutputChannel
+except Exception: #ImportError
+    from outputdispatcher import OutputDispatcher, OutputChannel
 
 
 class Event:
 
-    _data_dict = {}
+    """ Event record, every event owns its fields (events are held in windows and buffers by some stages) """
+    __slots__ = ('_id', '_src', '_time', '_db', '_sess', '_matomoParams', '_matomoRequest', 'is_robot')
 
     def __init__(self):
-        None
-
-    def __getattr__(self, attribute):
-        return self._data_dict.get(attribute, None)
-
-    def __setattr__(self, name, value):
-        self._data_dict[name] = value
+        self._id = None
+        self._src = None
+        self._time = None # solr time parsed once by the input stage
+        self._db = None
+        self._sess = None
+        self._matomoParams = None
+        self._matomoRequest = None
+        self.is_robot = None
+
+    def toDict(self):
+        return dict( (name, getattr(self, name)) for name in Event.__slots__ )
 
     def __str__(self):
-        return self._data_dict.__str__()
+        return self.toDict().__str__()
 
     def toJSON(self):
-        return json.dumps(self._data_dict, indent=4, sort_keys=True)
+        return json.dumps(self.toDict(), indent=4, sort_keys=True, default=str)
+
+class EventBatch:
+
+    """ Columnar batch of events (usually one solr page). Solr documents are kept as the events _src, the other event
+    fields are held in one list per field. Filters in batch mode work on whole columns """
+    def __init__(self, firstId, docs):
+        n = len(docs)
+        self.ids = list(range(firstId, firstId + n))
+        self.docs = docs
+        self.times = [None] * n
+        self.db = [None] * n
+        self.sess = [None] * n
+        self.matomoParams = [None] * n
+        self.matomoRequest = [None] * n
+        self.isRobot = [None] * n
+
+    def __len__(self):
+        return len(self.docs)
+
+    def column(self, name, default=None):
+        """ Returns the list of values of a solr field """
+        return [ doc.get(name, default) for doc in self.docs ]
+
+    def setColumn(self, name, values):
+        for (doc, value) in zip(self.docs, values):
+            doc[name] = value
+
+    def select(self, indices):
+        """ Returns a new batch with the events at the given positions """
+        batch = EventBatch(0, [ self.docs[i] for i in indices ])
+        for field in ('ids', 'times', 'db', 'sess', 'matomoParams', 'matomoRequest', 'isRobot'):
+            values = getattr(self, field)
+            setattr(batch, field, [ values[i] for i in indices ])
+        return batch
+
+    def toEvents(self):
+        for i in range(len(self.docs)):
+            event = Event()
+            event._id = self.ids[i]
+            event._src = self.docs[i]
+            event._time = self.times[i]
+            event._db = self.db[i]
+            event._sess = self.sess[i]
+            event._matomoParams = self.matomoParams[i]
+            event._matomoRequest = self.matomoRequest[i]
+            event.is_robot = self.isRobot[i]
+            yield event
+
+
+# filters of every ParallelFilters stage, installed in each worker process of the pipeline pool
+_workerStages = None
+_workerBatchMode = False
+
+def _initWorker(stages, batchMode):
+    global _workerStages, _workerBatchMode
+    _workerStages = stages
+    _workerBatchMode = batchMode
+    # forked workers inherit the state of the random generator, they would all draw the same values
+    random.seed()
+
+def _runChunkInWorker(stage, chunk):
+    items = iter(chunk)
+    for filter in _workerStages[stage]:
+        items = filter.runBatches(items) if _workerBatchMode else filter.run(items)
+    return list(items)
+
+
+class WorkerPool:
+
+    """ Process pool shared by every ParallelFilters stage of a pipeline. The filters of all stages are installed in
+    the workers once, when the pool starts """
+    def __init__(self, processes, batchMode):
+        self.processes = processes
+        self._batchMode = batchMode
+        self._stages = []
+        self._pool = None
+
+    def addStage(self, filters):
+        """ Registers the filters of a stage, returns the stage number used to submit chunks """
+        self._stages.append(filters)
+        return len(self._stages) - 1
+
+    def start(self):
+        """ Forks the workers, must be called before the pipeline starts any thread """
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes, initializer=_initWorker, initargs=(self._stages, self._batchMode))
+
+    def submit(self, stage, chunk):
+        return self._pool.apply_async(_runChunkInWorker, (stage, chunk))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+class ParallelFilters:
+
+    """ Runs a sequence of parallel safe filters in the pipeline worker pool over chunks of events (or whole batches
+    in batch mode). Results are yielded in the order of the input, at most two chunks per process are in flight """
+    def __init__(self, pool, filters, chunkSize):
+        self._pool = pool
+        self._filters = filters
+        self._stage = pool.addStage(filters)
+        self._chunkSize = chunkSize
+
+    def run(self, events):
+        events = iter(events)
+        return self._run(iter(lambda: list(islice(events, self._chunkSize)), []))
+
+    def runBatches(self, batches):
+        return self._run( [batch] for batch in batches )
+
+    def _run(self, chunks):
+        logger.debug('Running {} in {} processes'.format([type(filter).__name__ for filter in self._filters], self._pool.processes))
+
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(self._pool.submit(self._stage, chunk))
+
+            while len(pending) >= 2 * self._pool.processes:
+                yield from pending.popleft().get()
+
+        while len(pending) > 0:
+            yield from pending.popleft().get()
+
 
 class EventPipeline:
 
@@ -36,34 +175,70 @@ class EventPipeline:
     _filters_stage = []
     _output_stage = None
 
-    def __init__(self, input, filters, outputs):
+    def __init__(self, input, filters, outputs, batchMode=False, processes=1, chunkSize=500):
         self._input_stage = input
         self._filters_stage = filters
         self._output_stage = outputs
+        self._batchMode = batchMode
+        self._pool = None
+
+        # several outputs are fed from bounded queues, one thread per output
+        if isinstance(outputs, list):
+            self._output_stage = OutputDispatcher([ OutputChannel(type(output).__name__, output) for output in outputs ])
+
+        # consecutive parallel safe filters run together in a process pool
+        if processes > 1:
+            self._pool = WorkerPool(processes, batchMode)
+            self._filters_stage = self._parallelize(filters, chunkSize)
+
+    def _parallelize(self, filters, chunkSize):
+        stages = []
+        group = []
+        for filter in filters + [None]:
+            if filter is not None and getattr(filter, 'parallelSafe', False):
+                group.append(filter)
+                continue
+
+            if len(group) > 0:
+                stages.append(ParallelFilters(self._pool, group, chunkSize))
+                group = []
+
+            if filter is not None:
+                stages.append(filter)
+
+        return stages
 
     def run(self):
-        events = self._input_stage.run()
+        # the input completes its setup before any filter starts (ie: before worker processes copy the filters)
+        if hasattr(self._input_stage, 'prepare'):
+            self._input_stage.prepare()
+
+        # workers are forked while this is the only thread, input prefetching and outputs start their threads later
+        if self._pool is not None:
+            self._pool.start()
+
+        if self._batchMode:
+            # input and filters work on columnar batches, outputs still receive events
+            batches = self._input_stage.runBatches()
+
+            for filter in self._filters_stage:
+                batches = filter.runBatches(batches)
 
-        for filter in self._filters_stage:
-            events = filter.run(events)            
+            events = ( event for batch in batches for event in batch.toEvents() )
+        else:
+            events = self._input_stage.run()
+
+            for filter in self._filters_stage:
+                events = filter.run(events)            
 
         try:
             self._output_stage.run(events)
         except Exception as e: 
             logger.error( 'A fatal exception ocurred processing events !!!! {}'.format(e) )
             traceback.print_exc()
-
-
-
-        """    
-        # create and event iterator for every output (tee return tuple of size n)
-        events_iter = tee(events, len(self._output_stage)) 
-       
-        # run each output stage on each event iterator
-        for (output, teed_events) in zip(self._output_stage, events_iter):
-            try:
-                output.run(teed_events)
-            except Exception as e: 
-                logger.error( 'A fatal exception ocurred processing events !!!! {}'.format(e) )
-                traceback.print_exc()
-        """
\ No newline at end of file
+            # the caller decides what to do with the run (ie: matomo offline, retry in the next run)
+            raise
+        finally:
+            # every chunk was consumed by the outputs, or the run failed
+            if self._pool is not None:
+                self._pool.close()
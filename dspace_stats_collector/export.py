@@ -67,7 +67,10 @@ class EventPipelineBuilder:
                 SimpleHashSessionFilter(configContext),
                 MatomoFilter(configContext)
             ],
-            FileOutput(configContext)) 
+            FileOutput(configContext),
+            batchMode=(configContext.pipelineMode == 'batch'),
+            processes=configContext.pipelineProcesses,
+            chunkSize=configContext.solrQueryRows)
 
 
 def main():
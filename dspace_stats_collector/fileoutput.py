@@ -7,6 +7,13 @@ logger = logging.getLogger()
 
 
 import gzip
+import os
+
+# monthly archive files, named after the month of the events they hold
+ARCHIVE_FILENAME_PATTERN = "{repoName}_{year:04d}_{month:02d}.txt.gz"
+
+# the archive is flushed and its checkpoint saved at least every this number of events
+ARCHIVE_CHECKPOINT_EVENTS = 10000
 
 class FileOutput:
 
@@ -39,3 +46,66 @@ class FileOutput:
         ## if not robot write to file
         if event.is_robot == False:
             self._file.write(event._matomoRequest + '\n')
+
+
+class ArchiveOutput:
+
+    """ Local archive of the events sent by the collector. Requests are appended to one gzip file per month, chosen by
+    the time of each event, so consecutive runs add to the archive instead of replacing it. If history is given, the
+    (timestamp, uid) of the last archived event is saved there every time the appended lines are on disk (a month
+    file is closed, or flushed every ARCHIVE_CHECKPOINT_EVENTS events), so a failed run does not append them again """
+    def __init__(self, configContext, history=None):
+        self._directory = configContext.archiveDir
+        self._repoName = configContext.repoName
+        self._uniqueKey = configContext.solrUniqueKey
+        self._history = history
+        self._file = None
+        self._month = None
+        self._lastEvent = None
+        self._uncheckpointed = 0
+
+    def run(self, events):
+
+        if not os.path.exists(self._directory):
+            os.makedirs(self._directory)
+
+        archived = 0
+        try:
+            for event in events:
+                if event.is_robot == False:
+                    self._fileFor(event._time).write(event._matomoRequest + '\n')
+                    archived += 1
+
+                self._lastEvent = event
+                self._uncheckpointed += 1
+                if self._uncheckpointed >= ARCHIVE_CHECKPOINT_EVENTS:
+                    if self._file is not None:
+                        self._file.flush()
+                    self._checkpoint()
+        finally:
+            # also on errors, everything written up to the last event is kept and not appended again
+            self._close()
+
+        logger.info('DSpace Stats Archive appended {} events to {}'.format(archived, self._directory))
+
+    def _fileFor(self, time):
+        month = (time.year, time.month)
+        if month != self._month:
+            self._close()
+            filename = os.path.join(self._directory, ARCHIVE_FILENAME_PATTERN.format(repoName=self._repoName, year=time.year, month=time.month))
+            # every run appends a new gzip member, readers see the concatenation of all of them
+            self._file = gzip.open(filename, 'at')
+            self._month = month
+        return self._file
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._month = None
+        self._checkpoint()
+
+    def _checkpoint(self):
+        if self._history is not None and self._lastEvent is not None and self._uncheckpointed > 0:
+            self._history.save_last_tracked_timestamp(self._lastEvent._time, self._lastEvent._src.get(self._uniqueKey))
+        self._uncheckpointed = 0
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Bounded LRU cache """
+
+import logging
+logger = logging.getLogger()
+
+from collections import OrderedDict
+
+
+class LRUCache:
+
+    """ Dict based least recently used cache with a bounded number of entries.
+    Keeps hit, miss and eviction counters. None is a valid value, so it can be used for negative caching """
+    def __init__(self, maxSize):
+        self._maxSize = max(int(maxSize), 1)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """ Returns the cached value for key (and marks it as recently used) or default if not cached """
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """ Stores the value, evicting the least recently used entry if the cache is full """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        self._entries[key] = value
+
+        if len(self._entries) > self._maxSize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def getHitRatio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def __str__(self):
+        return 'entries: {}/{} hits: {} misses: {} evictions: {} hit ratio: {:.2%}'.format(
+            len(self._entries), self._maxSize, self.hits, self.misses, self.evictions, self.getHitRatio())
@@ -8,10 +8,20 @@ logger = logging.getLogger()
 import urllib.parse
 import json
 import random
-from datetime import datetime
-from pytz import timezone
 import requests
+import requests.adapters
 import copy
+import collections
+from concurrent.futures import ThreadPoolExecutor, Future
+
+try:
+    from .matomospool import MatomoSpool
+    from .solrtime import toMatomoTime
+    from .lrucache import LRUCache
+except Exception: #ImportError
+    from matomospool import MatomoSpool
+    from solrtime import toMatomoTime
+    from lrucache import LRUCache
 
 # define Python user-defined exceptions
 class MatomoException(Exception):
@@ -27,8 +37,14 @@ class MatomoInternalServerException(MatomoException):
     pass
 
 
+# resources whose encoded parameters are kept by the matomo filter
+RESOURCE_FRAGMENT_CACHE_SIZE = 10000
+
 class MatomoFilter:
 
+    # pure cpu work, can run in a process pool
+    parallelSafe = True
+
     def __init__(self, configContext):
 
         dspaceProperties = configContext.dspaceProperties
@@ -47,65 +63,104 @@ class MatomoFilter:
 
         self._repoProperties = configContext.properties
 
+        # https://developer.matomo.org/api-reference/tracking-api
+        # parameters constant for the whole run, encoded once
+        self._staticParams = [
+            ('idsite', self._repoProperties['matomo.idSite']),
+            ('rec', self._repoProperties['matomo.rec']),
+            ('apiv', 1),
+            ('token_auth', self._repoProperties['matomo.token_auth'])
+        ]
+        self._staticPrefix = '?' + urllib.parse.urlencode(self._staticParams)
+
+        # parameters constant per resource, encoded once per resource
+        self._resourceFragments = LRUCache(RESOURCE_FRAGMENT_CACHE_SIZE)
+
     def run(self, events):
         for event in events:
-            params = dict()
+            (params, request) = self._buildRequest(event._src, event._time, event._db, event._sess)
 
-            # https://developer.matomo.org/api-reference/tracking-api
-            params['idsite'] = self._repoProperties['matomo.idSite']
-            params['rec'] = self._repoProperties['matomo.rec']
-            params['action_name'] = event._db['record_title']
-            params['_id'] = event._sess['id']
-            params['rand'] = random.randint(1e5,1e6)
-            params['apiv'] = 1
+            event._matomoParams = params
+            event._matomoRequest = request
+            
+            logger.debug('MATOMO_FILTER:: Event: {} is_robot {}'.format(event._id, event.is_robot))
 
-            if 'referrer' in event._src.keys():  # Not always available
-                params['urlref'] = event._src['referrer']
+            yield event
 
-            params['ua'] = event._src['userAgent']
+        logger.debug('MATOMO_FILTER:: Resource fragments cache: {}'.format(self._resourceFragments))
 
-            oaipmhID = "oai:{}:{}".format(self._dspaceHostname, event._db['handle'])
-            params['cvar'] = json.dumps({"1": ["oaipmhID", oaipmhID], "2": ["repositoryID",self._repoProperties['matomo.repositoryId']], "3": ["countryID",self._repoProperties['matomo.countryISO']] })
+    def runBatches(self, batches):
+        for batch in batches:
+            for i in range(len(batch)):
+                (params, request) = self._buildRequest(batch.docs[i], batch.times[i], batch.db[i], batch.sess[i])
 
-            if event._db['is_download']:
-                params['download'] = "{dspaceUrl}/bitstream/{handle}/{sequence_id}/{filename}".format(
-                    dspaceUrl = self._dspaceUrl,
-                    handle = event._db['handle'],
-                    sequence_id = event._db['sequence_id'],
-                    filename = urllib.parse.quote(event._db['filename'])
-                )
-                params['url'] = params['download']
-            else: # Not a download
-                params['url'] = self._handleCanonicalPrefix + event._db['handle']
-                # event.download does not get generated
+                batch.matomoParams[i] = params
+                batch.matomoRequest[i] = request
 
-            params['token_auth'] = self._repoProperties['matomo.token_auth']
-            params['cip'] = event._src.get('ip', '0.0.0.0')
+            logger.debug('MATOMO_FILTER:: Batch of {} events'.format(len(batch)))
 
-            srctime = event._src['time']
-            try:  # parse with or without milliseconds
-                srctime = datetime.strptime(srctime, "%Y-%m-%dT%H:%M:%S.%fZ")
-            except:
-                srctime = datetime.strptime(srctime, "%Y-%m-%dT%H:%M:%SZ")
+            yield batch
 
-            try:  # if env locale is ok
-                utctime = srctime.astimezone(timezone('UTC'))
-            except:  # otherwise (naive datetime without timezone yet), report solr time as utc without converting
-                local_tz = timezone('UTC')
-                utctime = local_tz.localize(srctime)
+        logger.debug('MATOMO_FILTER:: Resource fragments cache: {}'.format(self._resourceFragments))
 
-            params['cdt'] = datetime.strftime(utctime, "%Y-%m-%d %H:%M:%S")
-            logger.debug('SOLR time {} got converted to UTC: {}'.format(event._src['time'], params['cdt']))
+    def _buildRequest(self, src, time, db, sess):
+        """ Returns the tracking api parameters of an event and the encoded request, made of the static prefix, the
+        resource fragment and the event fields """
 
-            event._matomoParams = params
-            event._matomoRequest = '?' + urllib.parse.urlencode(params)
-            
-            logger.debug('MATOMO_FILTER:: Event: {} is_robot {}'.format(event._id, event.is_robot))
+        (resourceParams, resourceFragment) = self._resourceFragment(src, db)
 
-            yield event
+        eventParams = [
+            ('_id', sess['id']),
+            ('rand', random.randint(1e5,1e6))
+        ]
+
+        if 'referrer' in src.keys():  # Not always available
+            eventParams.append( ('urlref', src['referrer']) )
+
+        eventParams.append( ('ua', src['userAgent']) )
+        eventParams.append( ('cip', src.get('ip', '0.0.0.0')) )
+        eventParams.append( ('cdt', toMatomoTime(time)) )
+
+        params = dict(self._staticParams + resourceParams + eventParams)
+        request = self._staticPrefix + '&' + resourceFragment + '&' + urllib.parse.urlencode(eventParams)
+
+        return (params, request)
+
+    def _resourceFragment(self, src, db):
+        """ Returns the parameters depending only on the resource and their encoded form, memoized by resource type and id """
+
+        key = (src['type'], src['id'])
+        fragment = self._resourceFragments.get(key)
+
+        if fragment is None:
+            oaipmhID = "oai:{}:{}".format(self._dspaceHostname, db['handle'])
+
+            params = [
+                ('action_name', db['record_title']),
+                ('cvar', json.dumps({"1": ["oaipmhID", oaipmhID], "2": ["repositoryID",self._repoProperties['matomo.repositoryId']], "3": ["countryID",self._repoProperties['matomo.countryISO']] }))
+            ]
+
+            if db['is_download']:
+                download = "{dspaceUrl}/bitstream/{handle}/{sequence_id}/{filename}".format(
+                    dspaceUrl = self._dspaceUrl,
+                    handle = db['handle'],
+                    sequence_id = db['sequence_id'],
+                    filename = urllib.parse.quote(db['filename'])
+                )
+                params.append( ('download', download) )
+                params.append( ('url', download) )
+            else: # Not a download
+                params.append( ('url', self._handleCanonicalPrefix + db['handle']) )
+                # event.download does not get generated
+
+            fragment = (params, urllib.parse.urlencode(params))
+            self._resourceFragments.put(key, fragment)
+
+        return fragment
 
 
 BULK_TRACKING_BATCH_SIZE_DEFAULT = 50
+CONCURRENT_REQUESTS_DEFAULT = 1
 
 class MatomoBufferedSender:
 
@@ -115,47 +170,77 @@ class MatomoBufferedSender:
         self._buffer = [] # init buffer 
         self._totalSent = 0
         self._url = configContext.getMatomoUrl()
+        self._uniqueKey = configContext.solrUniqueKey
         
         try:
             self._bufferSize = configContext.getMatomoOutputSize()
-            assert(self._maxBufferSize > 0)
+            assert(self._bufferSize > 0)
         except:
             self._bufferSize = BULK_TRACKING_BATCH_SIZE_DEFAULT
 
+        # number of bulk requests in flight at the same time
+        try:
+            self._concurrentRequests = configContext.getMatomoConcurrentRequests()
+            assert(self._concurrentRequests > 0)
+        except:
+            self._concurrentRequests = CONCURRENT_REQUESTS_DEFAULT
+
+        # pooled keep alive http session, ignoring ssl verification
+        self._session = requests.Session()
+        self._session.verify = False
+        self._session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=self._concurrentRequests))
+        self._session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=self._concurrentRequests))
+
+        # batches in flight, in the order they were sent
+        self._inFlight = collections.deque()
+        self._executor = ThreadPoolExecutor(max_workers=self._concurrentRequests) if self._concurrentRequests > 1 else None
+
+        # optional durable spool, requests are sent from it and kept while matomo is offline
+        self._spool = MatomoSpool(configContext.matomoSpoolDir) if configContext.matomoSpoolDir is not None else None
+        self._offline = False
+
     def getTotalSent(self):
         return self._totalSent
 
     def send(self, event):
-        self._buffer.append((event._matomoRequest, event.is_robot, event._src['time']))
-        logger.debug( "Event json dump: {}".format( event.toJSON() ) )
+        # the solr unique key is only retrieved in cursor paging mode, it is None otherwise
+        self._buffer.append((event._matomoRequest, event.is_robot, event._src['time'], event._src.get(self._uniqueKey)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug( "Event json dump: {}".format( event.toJSON() ) )
         
         #print(self._buffer)
         if self.isBufferFull():
             logger.debug("Buffer is full")
-            self.flush()
+            self.flush(wait=False)
       
     def isBufferFull(self):
         return len(self._buffer) == self._bufferSize
 
     def _sendRequestsToMatomo(self, url, events):
        
-        lastEventTimestamp = events[-1][2]
-        request_list = [m for (m, r, t) in events if not r ]
-        self._totalSent += len(request_list)
+        request_list = [m for (m, r, t, u) in events if not r ]
 
         try:            
             if len(request_list) > 0: #sends only non empty lists
 
-                # http_response = requests.post(url, data = json.dumps( dict( requests = request_list, token_auth = self._configContext.getMatomoTokenAuth()) ))
-                # ignore ssl verification
-                http_response = requests.post(url, data = json.dumps( dict( requests = request_list, token_auth = self._configContext.getMatomoTokenAuth()) ), verify=False)
+                http_response = self._session.post(url, data = json.dumps( dict( requests = request_list, token_auth = self._configContext.getMatomoTokenAuth()) ))
                 
-                #http_response = requests.post(url, data = json.dumps( dict( requests = [ e._matomoRequest for e in events if not e.is_robot  ], token_auth = self._configContext.getMatomoTokenAuth()) ))
                 http_response.raise_for_status()
                 json_response = json.loads(http_response.text)
             
-                if json_response['status'] != "success" or json_response['invalid'] != 0:
+                if json_response['status'] != "success":
                     raise MatomoInternalServerException(http_response.text, json_response)
+
+                if json_response['invalid'] != 0:
+                    # valid requests in the batch were tracked, only the reported ones need to be discarded
+                    if 'invalid_indices' not in json_response:
+                        raise MatomoInternalServerException(http_response.text, json_response)
+
+                    for index in json_response['invalid_indices']:
+                        logger.error('Matomo reported request {} as invalid. This event will be discarded.'.format(index))
+                        logger.debug('Request Payload was: {}'.format(request_list[index]) )
+
+                    return len(request_list) - len(json_response['invalid_indices'])
             else:
                 logger.debug("There are no events to send")  #Modificación MEMO#
         
@@ -168,53 +253,140 @@ class MatomoBufferedSender:
         except requests.exceptions.RequestException as e:
             raise MatomoOfflineException(str(e))
 
-        return lastEventTimestamp
+        return len(request_list)
 
+    def _sendBisecting(self, events):
+        """ Sends the events in one request, if it fails splits them in halves recursively, so failed events are 
+        isolated in a logarithmic number of requests. Returns the number of requests sent """
 
-    def flush(self):
+        if len(events) == 0:
+            return 0
 
-        if(len(self._buffer)>0):
+        try:
+            return self._sendRequestsToMatomo(self._url, events)
 
-            lastEventTimestamp = None
+        except MatomoInternalServerException as e:
 
-            try: 
-                # try to send all buffered events        
-                lastEventTimestamp = self._sendRequestsToMatomo(self._url, self._buffer)
+            if len(events) == 1: # if there is some internal error will discard this event and log the result
+                logger.error('Matomo internal error occurred: {} with event. This event will be discarded.\n'.format( str(e)) )    
+                logger.debug('Request URL was: {}'.format(self._url) )        
+                logger.debug('Request Payload was: {}'.format(events[0][0]) )        
+                return 0
 
-            except MatomoOfflineException as e:
-                # if is offline will break the execution
-                raise
+            half = len(events) // 2
+            return self._sendBisecting(events[:half]) + self._sendBisecting(events[half:])
 
-            except MatomoInternalServerException as e:
+    def _sendBatch(self, batch):
+        """ Sends a batch of buffered events, returns the checkpoint (timestamp, uid) of its last event and the number of
+        requests sent. Runs in the executor threads when sending concurrently """
 
-                # if some there is some internal problem, the will try to send each event 
+        lastEventCheckpoint = (batch[-1][2], batch[-1][3])
+        sent = 0
 
-                logger.error('Matomo internal error detected processing events in bulk. Retrying in one event per request mode: Error was: {}'.format( str(e) ) )            
+        try: 
+            # try to send all buffered events        
+            sent = self._sendRequestsToMatomo(self._url, batch)
 
-                for (m, r, t) in self._buffer:
+        except MatomoOfflineException as e:
+            # if is offline will break the execution
+            raise
 
-                    try:
-                        lastEventTimestamp = t # in this mode, the event timestamp is always assigned as the last timestamp
-                        if not r:
-                            self._sendRequestsToMatomo(self._url, [(m, r, t)]) # send one event
-                            self._totalSent += 1
-                            #logger.info('totalSent + 1 after error')
+        except MatomoInternalServerException as e:
 
-                    except MatomoOfflineException as e: # if server is down break
-                        raise 
-                    
-                    except MatomoInternalServerException as e: # if there is some internal error will discard this event and log the result
-                        logger.error('Matomo internal error occurred: {} with event. This event will be discarded.\n'.format( str(e)) )    
-                        logger.debug('Request URL was: {}'.format(self._url) )        
-                        logger.debug('Request Payload was: {}'.format(m) )        
+            # if some there is some internal problem, will split the batch to isolate the failed events
+            logger.error('Matomo internal error detected processing events in bulk. Retrying in halves to isolate the failed events: Error was: {}'.format( str(e) ) )            
 
+            events = [ (m, r, t, u) for (m, r, t, u) in batch if not r ]
+            sent = self._sendBisecting(events[:len(events)//2]) + self._sendBisecting(events[len(events)//2:])
 
+        return (lastEventCheckpoint, sent)
 
-            if lastEventTimestamp != None:
-                self._configContext.history.save_last_tracked_timestamp(lastEventTimestamp)
-            
+    def flush(self, wait=True):
+        """ Sends the buffered events. If wait is False and requests are sent concurrently, returns as soon as there is
+        room for another batch in flight """
+
+        if(len(self._buffer)>0):
+            batch = self._buffer
             self._buffer = [] #Clean buffer
 
+            if self._spool is None:
+                self._submit(batch, None)
+            else:
+                # events are durable once spooled, so the checkpoint advances before sending them
+                spooled = [ (m, t, u) for (m, r, t, u) in batch if not r ]
+                position = self._spool.append(spooled) if len(spooled) > 0 else None
+                (lastEventTimestamp, lastEventUid) = (batch[-1][2], batch[-1][3])
+                self._configContext.history.save_last_tracked_timestamp(lastEventTimestamp, lastEventUid)
+
+                if position is not None and not self._offline:
+                    self._submit([ (m, False, t, u) for (m, t, u) in spooled ], position)
+
+        self._collect(wait)
+
+    def drain(self):
+        """ Sends the requests left in the spool by previous runs """
+
+        if self._spool is None or self._spool.isEmpty():
+            return
+
+        logger.info('Sending events spooled in previous runs')
+        for (spooled, position) in self._spool.read(self._bufferSize):
+            if self._offline:
+                break
+            self._submit([ (m, False, t, u) for (m, t, u) in spooled ], position)
+            self._collect(wait=False)
+
+    def _submit(self, batch, position):
+        """ Sends a batch, concurrently if there is an executor. position is the spool position after the batch, None if not spooled """
+
+        if self._executor is None:
+            future = Future()
+            try:
+                future.set_result(self._sendBatch(batch))
+            except MatomoException as e:
+                future.set_exception(e)
+        else:
+            future = self._executor.submit(self._sendBatch, batch)
+
+        self._inFlight.append((future, position))
+
+    def _collect(self, wait):
+
+        # the checkpoint only advances past the contiguous prefix of acknowledged batches
+        while len(self._inFlight) > 0 and (wait or len(self._inFlight) >= self._concurrentRequests or self._inFlight[0][0].done()):
+            (future, position) = self._inFlight.popleft()
+            try:
+                self._acknowledge(future.result(), position)
+            except MatomoException as e:
+                # do not send the remaining batches, they will be sent again in the next run
+                for (pending, _) in self._inFlight:
+                    pending.cancel()
+                self._inFlight.clear()
+
+                if self._spool is None or not isinstance(e, MatomoOfflineException):
+                    raise
+
+                # keep spooling the remaining events, they will be sent in the next run
+                logger.error("Matomo is offline. Spooled events will be sent in the next run. Error was: %s" % e)
+                self._offline = True
+
+    def _acknowledge(self, result, position):
+        (lastEventCheckpoint, sent) = result
+        self._totalSent += sent
+
+        if position is None:
+            (lastEventTimestamp, lastEventUid) = lastEventCheckpoint
+            self._configContext.history.save_last_tracked_timestamp(lastEventTimestamp, lastEventUid)
+        else:
+            self._spool.acknowledge(position)
+
+    def close(self):
+        self._session.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        if self._spool is not None:
+            self._spool.close()
+
 class MatomoOutput:
 
     def __init__(self, configContext):
@@ -226,6 +398,9 @@ class MatomoOutput:
         
         processed = 0
         robots_count = 0  
+
+        # events spooled in previous runs go first
+        self._sender.drain()
                 
         for event in events:
             processed += 1
@@ -238,7 +413,10 @@ class MatomoOutput:
 
         logger.debug('How many robots: {}'.format(robots_count))
         logger.debug('FORCE FLUSHING')
-        self._sender.flush()
+        try:
+            self._sender.flush()
+        finally:
+            self._sender.close()
         
         #logger.debug("Starting processing: %s on: %s from date: %s" % (repoName, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), configContext.history.get_last_tracked_timestamp())) 
         logger.info('DSpace Stats Collector finished processing {} events from {} to {}. Breakdown: {} events sent succesfully, {} events discarted as robot'.format(processed, self._configContext.solrQueryInitialTimestamp, self._configContext.history.get_last_tracked_timestamp(), self._sender.getTotalSent(), robots_count))
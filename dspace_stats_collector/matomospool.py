@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Durable spool of Matomo tracking requests """
+
+import logging
+logger = logging.getLogger()
+
+import os
+import re
+import json
+
+# a new segment file is started when the current one grows over this size
+DEFAULT_SEGMENT_MAX_BYTES = 16 * 1024 * 1024
+
+SEGMENT_FILENAME_PATTERN = "segment-{:012d}.log"
+SEGMENT_FILENAME_REGEX = re.compile(r'^segment-(\d{12})\.log$')
+POSITION_FILENAME = "position"
+
+
+class MatomoSpool:
+
+    """ Write ahead spool of enriched Matomo requests. Requests are appended to fsynced segment files before being sent,
+    so the solr checkpoint can advance once they are spooled. A position (segment, offset) records the prefix of the
+    spool already acknowledged by Matomo, fully acknowledged segments are deleted """
+    def __init__(self, directory, segmentMaxBytes=DEFAULT_SEGMENT_MAX_BYTES):
+        self._directory = directory
+        self._segmentMaxBytes = segmentMaxBytes
+        self._file = None
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._position = self._readPosition()
+
+        segments = self._listSegments()
+        if len(segments) > 0:
+            self._segment = segments[-1]
+        else:
+            # nothing left to send, keep numbering from the acknowledged segment
+            self._segment = self._position[0]
+            self._position = (self._segment, 0)
+
+        # discard an incomplete last record, left by a crash while appending
+        filename = self._segmentFilename(self._segment)
+        if os.path.exists(filename):
+            with open(filename, 'rb+') as f:
+                data = f.read()
+                end = data.rfind(b'\n') + 1
+                if end < len(data):
+                    logger.warning('Discarding incomplete record at the end of spool segment {}'.format(filename))
+                    f.truncate(end)
+                    os.fsync(f.fileno())
+
+        logger.debug('Matomo spool {} opened at position {}, {} segments'.format(directory, self._position, len(segments)))
+
+    def isEmpty(self):
+        return self._position >= self._endPosition()
+
+    def append(self, requests):
+        """ Appends a list of (request, timestamp, uid) and syncs them to disk.
+        :return: spool position after the appended requests
+        """
+        if self._file is not None and self._file.tell() >= self._segmentMaxBytes:
+            self._file.close()
+            self._file = None
+            self._segment += 1
+
+        if self._file is None:
+            self._file = open(self._segmentFilename(self._segment), 'ab')
+
+        self._file.write(b''.join( (json.dumps(request) + '\n').encode('utf-8') for request in requests ))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        return (self._segment, self._file.tell())
+
+    def read(self, batchSize):
+        """ Generator of (list of (request, timestamp, uid), spool position after them) for the requests not acknowledged yet,
+        up to the end of the spool at the moment of the call """
+        (firstSegment, offset) = self._position
+        (lastSegment, _) = self._endPosition()
+
+        for segment in range(firstSegment, lastSegment + 1):
+            filename = self._segmentFilename(segment)
+            if not os.path.exists(filename):
+                continue
+
+            with open(filename, 'rb') as f:
+                if segment == firstSegment:
+                    f.seek(offset)
+
+                batch = []
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    batch.append(tuple(json.loads(line.decode('utf-8'))))
+                    if len(batch) == batchSize:
+                        yield (batch, (segment, f.tell()))
+                        batch = []
+
+                if len(batch) > 0:
+                    yield (batch, (segment, f.tell()))
+
+    def acknowledge(self, position):
+        """ Marks the spool as acknowledged up to position, deleting the segments before it """
+        if position <= self._position:
+            return
+
+        self._position = position
+
+        tmpFilename = self._positionFilename() + '.tmp'
+        with open(tmpFilename, 'w') as f:
+            f.write('{} {}\n'.format(*position))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpFilename, self._positionFilename())
+
+        for segment in self._listSegments():
+            if segment < position[0]:
+                os.remove(self._segmentFilename(segment))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        logger.debug('Matomo spool {} closed at position {}'.format(self._directory, self._position))
+
+    def _endPosition(self):
+        filename = self._segmentFilename(self._segment)
+        size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        return (self._segment, size)
+
+    def _listSegments(self):
+        segments = []
+        for filename in os.listdir(self._directory):
+            m = SEGMENT_FILENAME_REGEX.match(filename)
+            if m is not None:
+                segments.append(int(m.group(1)))
+        return sorted(segments)
+
+    def _readPosition(self):
+        try:
+            with open(self._positionFilename()) as f:
+                (segment, offset) = f.read().split()
+                return (int(segment), int(offset))
+        except FileNotFoundError:
+            return (0, 0)
+
+    def _positionFilename(self):
+        return os.path.join(self._directory, POSITION_FILENAME)
+
+    def _segmentFilename(self, segment):
+        return os.path.join(self._directory, SEGMENT_FILENAME_PATTERN.format(segment))
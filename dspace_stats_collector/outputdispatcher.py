@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Fan out of events to several output stages """
+
+import logging
+logger = logging.getLogger()
+
+import threading
+import traceback
+from queue import Queue, Full
+
+try:
+    from .solrtime import parseSolrTime
+except Exception: #ImportError
+    from solrtime import parseSolrTime
+
+DEFAULT_OUTPUT_QUEUE_SIZE = 1000
+
+# put timeout, allows to notice outputs that stopped consuming
+QUEUE_PUT_TIMEOUT = 0.5
+
+_END = object()
+
+
+class OutputChannel:
+
+    """ An output fed by the dispatcher. checkpoint is the (timestamp, uid) of the last event the output already
+    processed in previous runs, events up to it are not delivered again. If history is given the timestamp of the
+    last delivered event is saved there when the output finishes. An exception raised by the output is kept in
+    error, the dispatcher raises it once every output finished """
+    def __init__(self, name, output, checkpoint=None, history=None, uniqueKey='uid', queueSize=DEFAULT_OUTPUT_QUEUE_SIZE):
+        self.name = name
+        self.output = output
+        self.history = history
+        self.queue = Queue(maxsize=queueSize)
+        self.finished = False
+        self.error = None
+        self.delivered = 0
+        self._uniqueKey = uniqueKey
+        self._lastEvent = None
+
+        if checkpoint is not None and checkpoint[0] is not None:
+            self._checkpoint = (parseSolrTime(checkpoint[0]), checkpoint[1])
+        else:
+            self._checkpoint = None
+
+    def events(self):
+        """ Generator of the events taken from the queue, consumed by the output run method """
+        while True:
+            event = self.queue.get()
+            if event is _END:
+                return
+
+            # events are ordered by time, the checkpoint is only checked until the first newer event
+            if self._checkpoint is not None:
+                if self._isProcessed(event):
+                    continue
+                self._checkpoint = None
+
+            self._lastEvent = event
+            self.delivered += 1
+            yield event
+
+    def _isProcessed(self, event):
+        (checkpointTime, checkpointUid) = self._checkpoint
+        if event._time != checkpointTime:
+            return event._time < checkpointTime
+        uid = event._src.get(self._uniqueKey)
+        return checkpointUid is None or (uid is not None and uid <= checkpointUid)
+
+    def run(self):
+        try:
+            self.output.run(self.events())
+
+            if self.history is not None and self._lastEvent is not None:
+                self.history.save_last_tracked_timestamp(self._lastEvent._time, self._lastEvent._src.get(self._uniqueKey))
+
+        except Exception as e:
+            logger.error( 'A fatal exception ocurred processing events in output {} !!!! {}'.format(self.name, e) )
+            traceback.print_exc()
+            self.error = e
+
+        finally:
+            self.finished = True # from here on nothing consumes the queue
+
+
+class OutputDispatcher:
+
+    """ Output stage feeding every event to several outputs. Each output runs in its own thread reading from a
+    bounded queue, so the slowest one sets the pace of the input instead of buffering without limit """
+    def __init__(self, channels):
+        self._channels = channels
+
+    def run(self, events):
+        threads = []
+        for channel in self._channels:
+            thread = threading.Thread(target=channel.run, name='output-' + channel.name, daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        try:
+            for event in events:
+                for channel in self._channels:
+                    self._put(channel, event)
+        finally:
+            for channel in self._channels:
+                self._put(channel, _END)
+
+            for thread in threads:
+                thread.join()
+
+        for channel in self._channels:
+            logger.debug('Output {} received {} events'.format(channel.name, channel.delivered))
+
+        # the other outputs finished their work, the first error (ie: matomo offline) is handled by the caller
+        for channel in self._channels:
+            if channel.error is not None:
+                raise channel.error
+
+    def _put(self, channel, item):
+        while not channel.finished:
+            try:
+                channel.queue.put(item, timeout=QUEUE_PUT_TIMEOUT)
+                return
+            except Full:
+                pass
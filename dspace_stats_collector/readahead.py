@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Background iteration helpers """
+
+import logging
+logger = logging.getLogger()
+
+import queue
+import threading
+
+# seconds between checks of the stop flag while the queue is full
+_PUT_TIMEOUT = 0.5
+
+
+class _End:
+    """ Marks the end of the iteration, holds the exception raised by the source iterable if any """
+    def __init__(self, error=None):
+        self.error = error
+
+
+class BackgroundIterator:
+
+    """ Iterates a source iterable in a daemon thread, keeping at most 'depth' items ready in a bounded queue.
+    Exceptions raised by the source are raised again in the consumer thread """
+    def __init__(self, iterable, depth=1, name='background-iterator'):
+        self._queue = queue.Queue(maxsize=max(int(depth), 1))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(iterable,), name=name, daemon=True)
+        self._thread.start()
+
+    def _produce(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put(item):
+                    return
+            self._put(_End())
+        except Exception as e:
+            self._put(_End(e))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if isinstance(item, _End):
+                    if item.error is not None:
+                        raise item.error
+                    return
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """ Stops the producer thread (it may be blocked waiting for room in the queue) """
+        self._stop.set()
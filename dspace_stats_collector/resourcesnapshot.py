@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" In memory snapshot of DSpace resources """
+
+import logging
+logger = logging.getLogger()
+
+import os
+import sys
+import time
+import pickle
+from datetime import timedelta
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+# items modified slightly before the stored watermark are read again to tolerate clock/timezone differences
+WATERMARK_SAFETY_MARGIN = timedelta(days=1)
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ResourceRecord:
+
+    """ Compact representation of a resource row """
+    __slots__ = ('record_title', 'handle', 'is_download', 'owning_item', 'sequence_id', 'filename')
+
+    def __init__(self, resource):
+        for name in ResourceRecord.__slots__:
+            value = resource.get(name)
+            # numpy / driver scalars are converted to python values
+            if hasattr(value, 'item'):
+                value = value.item()
+            setattr(self, name, _intern(value))
+
+    def toDict(self):
+        return dict( (name, getattr(self, name)) for name in ResourceRecord.__slots__ )
+
+
+class ResourceSnapshot:
+
+    """ Holds every item and bitstream of the repository in memory. It is used by DSpaceDB as its resource cache,
+    so ids not found in the snapshot (ie: items created after the last refresh) are still queried and added to it.
+    The snapshot is saved to disk and refreshed incrementally in the next run based on item.last_modified """
+    def __init__(self, filename, maxAge):
+        self._filename = filename
+        self._maxAge = maxAge
+        self._records = {}
+        self._watermark = None
+        self._loadedAt = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            record = self._records[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return record.toDict() if record is not None else None
+
+    def put(self, key, value):
+        self._records[key] = ResourceRecord(value) if value is not None else None
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def __str__(self):
+        return 'snapshot entries: {} hits: {} misses: {}'.format(len(self._records), self.hits, self.misses)
+
+    def refresh(self, db):
+        """ Loads the snapshot from disk and updates it with the items modified since, or loads it entirely from db
+        if there is no usable snapshot on disk """
+        start = time.time()
+        watermark = db.getLastModified()
+
+        if self._load():
+            modifiedSince = self._watermark - WATERMARK_SAFETY_MARGIN if self._watermark is not None else None
+            logger.debug('Refreshing resource snapshot with items modified since {}'.format(modifiedSince))
+        else:
+            modifiedSince = None
+            self._records = {}
+            self._loadedAt = time.time()
+            logger.debug('Loading full resource snapshot from db')
+
+        # when refreshing, rows of modified resources replace the old ones
+        seen = set()
+        for (key, resource) in db.streamResources(modifiedSince):
+            if key in seen: # resources with more than one row (ie: several titles) can not be resolved
+                self._records[key] = None
+            else:
+                seen.add(key)
+                self._records[key] = ResourceRecord(resource)
+
+        # pandas reports null timestamps as NaT
+        if watermark is not None and watermark == watermark:
+            self._watermark = watermark.to_pydatetime() if hasattr(watermark, 'to_pydatetime') else watermark
+        else:
+            self._watermark = None
+        logger.info('Resource snapshot ready: {} resources ({} read from db) in {:.1f}s'.format(len(self._records), len(seen), time.time() - start))
+
+        self._save()
+
+    def _load(self):
+        try:
+            with open(self._filename, 'rb') as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.error('Could not read resource snapshot {}: {}'.format(self._filename, e))
+            return False
+
+        if data.get('version') != SNAPSHOT_FORMAT_VERSION:
+            return False
+
+        # a full reload is forced from time to time, incremental refreshes do not see deleted resources
+        if time.time() - data['loadedAt'] > self._maxAge:
+            logger.debug('Resource snapshot {} is too old, ignoring it'.format(self._filename))
+            return False
+
+        self._records = data['records']
+        self._watermark = data['watermark']
+        self._loadedAt = data['loadedAt']
+        return True
+
+    def _save(self):
+        dirname = os.path.dirname(self._filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        # ids that could not be resolved are not persisted, they may be resolvable in the next run
+        data = {
+            'version': SNAPSHOT_FORMAT_VERSION,
+            'watermark': self._watermark,
+            'loadedAt': self._loadedAt,
+            'records': dict( (key, record) for (key, record) in self._records.items() if record is not None )
+        }
+
+        tmpFilename = self._filename + '.tmp'
+        with open(tmpFilename, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpFilename, self._filename)
+
+    def close(self):
+        """ Persists resources resolved during the run """
+        self._save()
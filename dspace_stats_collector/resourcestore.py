@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Persistent resource metadata store """
+
+import logging
+logger = logging.getLogger()
+
+import os
+import json
+import sqlite3
+import time
+
+
+def _toJSONValue(value):
+    # db drivers / pandas may return numpy scalars
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+class SQLiteResourceStore:
+
+    """ Persistent cache of resources recovered from the DSpace db, shared across collector runs.
+    Entries are keyed by repository name and resource id and expire after ttl seconds """
+    def __init__(self, filename, repository, ttl):
+        self._repository = repository
+        self._ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self._conn = sqlite3.connect(filename, timeout=60)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS resource (
+                repository TEXT NOT NULL,
+                id TEXT NOT NULL,
+                record TEXT NOT NULL,
+                cached_at REAL NOT NULL,
+                PRIMARY KEY (repository, id)
+            )
+        """)
+
+        # purge expired entries
+        purged = self._conn.execute("DELETE FROM resource WHERE repository = ? AND cached_at < ?", (self._repository, time.time() - self._ttl)).rowcount
+        self._conn.commit()
+        logger.debug('Resource store {} opened, {} expired entries purged'.format(filename, purged))
+
+    def getMany(self, resourceIds):
+        """ Returns a dict id -> resource dict with the non expired entries found for resourceIds """
+        resources = {}
+        resourceIds = list(resourceIds)
+        minCachedAt = time.time() - self._ttl
+
+        # sqlite limits the number of host parameters per statement
+        for start in range(0, len(resourceIds), 500):
+            chunk = resourceIds[start:start + 500]
+            SQL = "SELECT id, record FROM resource WHERE repository = ? AND cached_at >= ? AND id IN ({})".format(', '.join('?' * len(chunk)))
+            for (resourceId, record) in self._conn.execute(SQL, [self._repository, minCachedAt] + chunk):
+                resources[resourceId] = json.loads(record)
+
+        self.hits += len(resources)
+        self.misses += len(resourceIds) - len(resources)
+        return resources
+
+    def putMany(self, resources):
+        """ Stores a dict id -> resource dict """
+        if len(resources) == 0:
+            return
+
+        now = time.time()
+        self._conn.executemany("INSERT OR REPLACE INTO resource (repository, id, record, cached_at) VALUES (?, ?, ?, ?)",
+            [ (self._repository, resourceId, json.dumps(record, default=_toJSONValue), now) for (resourceId, record) in resources.items() ])
+        self._conn.commit()
+
+    def close(self):
+        logger.debug('Resource store:: hits: {} misses: {}'.format(self.hits, self.misses))
+        self._conn.close()
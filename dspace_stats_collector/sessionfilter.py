@@ -5,67 +5,146 @@
 import logging
 logger = logging.getLogger()
 
-from dateutil import parser as dateutil_parser
 from hashlib import md5
-from anonymizeip import anonymize_ip
-from ipaddress import ip_address
+from ipaddress import ip_address, IPv4Address, IPv6Address
+
+try:
+    from .lrucache import LRUCache
+except Exception: #ImportError
+    from lrucache import LRUCache
+
+# mask applied to ipv6 addresses (default of the anonymizeip package used before)
+IPV6_ANONYMIZE_MASK = 'ffff:ffff:ffff:ffff:0000:0000:0000:0000'
+
+SESSION_CACHE_SIZE = 10000
+ANONYMIZED_IP_CACHE_SIZE = 10000
 
 
 class SimpleHashSessionFilter:
 
+    # pure cpu work, can run in a process pool
+    parallelSafe = True
+
     FULL_IP_MASK = '255.255.255.255'
 
     def __init__(self, configContext):
         self._anonymize_ip_mask = configContext.anonymize_ip_mask
 
+        # masks parsed once to integers, an invalid ipv4 mask anonymizes every ipv4 address as 0.0.0.0
+        self._ipv4Mask = None
+        self._ipv6Mask = int(ip_address(IPV6_ANONYMIZE_MASK))
+        if self._anonymize_ip_mask != self.FULL_IP_MASK:
+            try:
+                self._ipv4Mask = self._parseIPv4Mask(self._anonymize_ip_mask)
+            except ValueError as e:
+                logger.error("Invalid anonymize.ip_mask {}: {}".format(self._anonymize_ip_mask, e))
+
+        # (day, ip, user agent) -> session dict and raw ip -> anonymized ip
+        self._sessions = LRUCache(SESSION_CACHE_SIZE)
+        self._anonymizedIps = LRUCache(ANONYMIZED_IP_CACHE_SIZE)
+
 
     def run(self, events):
         for event in events:
-            srcString = "{:%Y-%m-%d}#{}#{}".format(
-                            dateutil_parser.parse(event._src['time']),
-                            event._src.get('ip', '0.0.0.0'),
-                            event._src.get('userAgent', None)
-                        )
+            event._sess = self._session(event._time, event._src.get('ip', '0.0.0.0'), event._src.get('userAgent', None))
+
+            # Anonymize IP
+            if self._anonymize_ip_mask != self.FULL_IP_MASK:     
+                event._src['ip'] = self._anonymizeIpMemo(event._src.get('ip','0.0.0.0'))
+
+            logger.debug('SESSION_FILTER:: Event: {} Session string: {}'.format(event._id, event._sess['srcString']))
+
+            yield event
+
+        logger.debug('SESSION_FILTER:: Sessions cache: {} Anonymized ips cache: {}'.format(self._sessions, self._anonymizedIps))
+
+    def runBatches(self, batches):
+        for batch in batches:
+            ips = batch.column('ip', '0.0.0.0')
+            userAgents = batch.column('userAgent')
+
+            batch.sess = [ self._session(time, ip, userAgent) for (time, ip, userAgent) in zip(batch.times, ips, userAgents) ]
+
+            # Anonymize IPs
+            if self._anonymize_ip_mask != self.FULL_IP_MASK:     
+                batch.setColumn('ip', [ self._anonymizeIpMemo(ip) for ip in ips ])
+
+            logger.debug('SESSION_FILTER:: Batch of {} events'.format(len(batch)))
+
+            yield batch
+
+        logger.debug('SESSION_FILTER:: Sessions cache: {} Anonymized ips cache: {}'.format(self._sessions, self._anonymizedIps))
+
+    def _session(self, time, ip, userAgent):
+        """ Returns the session dict of an event, events of the same session share it and it is hashed only once """
+        key = (time.date(), ip, userAgent)
+        sessDict = self._sessions.get(key)
+
+        if sessDict is None:
+            srcString = "{:%Y-%m-%d}#{}#{}".format(time, ip, userAgent)
             sessDict = {
                         'id': md5(srcString.encode()).hexdigest(),
                         'srcString': srcString
                        }
-            event._sess = sessDict
+            self._sessions.put(key, sessDict)
 
+        return sessDict
 
-            try:
-                # Anonymize IP
-                if self._anonymize_ip_mask != self.FULL_IP_MASK:     
-                    event._src['ip'] = anonymize_ip(event._src.get('ip','0.0.0.0'), self._anonymize_ip_mask)    
-            
-            except Exception as e:
+    def _anonymizeIpMemo(self, ip):
+        anonymized = self._anonymizedIps.get(ip)
+        if anonymized is None:
+            anonymized = self._anonymizeIp(ip)
+            self._anonymizedIps.put(ip, anonymized)
+        return anonymized
 
-                 # check if ip is folowing the format ip:port
-                if ':' in event._src.get('ip','0.0.0.0'):
+    @staticmethod
+    def _parseIPv4Mask(mask):
+        """ Returns the ipv4 mask as an integer, only 0 and 255 octets are allowed and it must mask something """
+        packed = ip_address(mask).packed
+        if len(packed) != 4 or any(octet not in (0, 255) for octet in packed) or packed == b'\x00\x00\x00\x00':
+            raise ValueError("ipv4 mask must be made of 0 and 255 octets and keep some of them")
+        return int(ip_address(mask))
 
-                    splited = event._src.get('ip','0.0.0.0').split(':')
+    def _maskIp(self, ip):
+        """ Applies the mask to the ip address, raises ValueError if it is not a valid address """
+        address = ip_address(ip)
 
-                    if len(splited) > 1:
-                        ip = splited[0]
-                    else:
-                        ip = '0.0.0.0'
-                    
-                    ## check the ip string is a valid ip address
-                    try:
-                        # this will raise a ValueError if the ip is not valid
-                        ip_address(ip)
-
-                        # anonymize ip
-                        event._src['ip'] = anonymize_ip(ip, self._anonymize_ip_mask)
-
-                    except ValueError:
-                        logger.error("Error anonymizing parsed IP from XXXX:port pattern: {}".format(e))         
-                        event._src['ip'] = '0.0.0.0'
-                        
-                else:
-                    logger.error("Error anonymizing IP: {}".format(e))
-                    event._src['ip'] = '0.0.0.0'
+        if isinstance(address, IPv4Address):
+            if self._ipv4Mask is None:
+                raise ValueError("no valid ipv4 mask")
+            return str(IPv4Address(int(address) & self._ipv4Mask))
+
+        return str(IPv6Address(int(address) & self._ipv6Mask))
+
+    def _anonymizeIp(self, ip):
+
+        try:
+            return self._maskIp(ip)
+        
+        except Exception as e:
 
-            logger.debug('SESSION_FILTER:: Event: {} Session string: {}'.format(event._id, srcString))
+             # check if ip is folowing the format ip:port
+            if ':' in ip:
 
-            yield event
\ No newline at end of file
+                splited = ip.split(':')
+
+                if len(splited) > 1:
+                    ip = splited[0]
+                else:
+                    ip = '0.0.0.0'
+                
+                ## check the ip string is a valid ip address
+                try:
+                    # this will raise a ValueError if the ip is not valid
+                    ip_address(ip)
+
+                    # anonymize ip
+                    return self._maskIp(ip)
+
+                except ValueError:
+                    logger.error("Error anonymizing parsed IP from XXXX:port pattern: {}".format(e))         
+                    return '0.0.0.0'
+                    
+            else:
+                logger.error("Error anonymizing IP: {}".format(e))
+                return '0.0.0.0'
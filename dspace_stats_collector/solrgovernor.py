@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Throttling of solr requests """
+
+import logging
+logger = logging.getLogger()
+
+import threading
+import time
+
+# first wait after a slow response, doubled on every consecutive slow response
+BACKOFF_INITIAL_SECONDS = 1.0
+DEFAULT_MAX_BACKOFF_SECONDS = 60.0
+
+
+class SolrLoadGovernor:
+
+    """ Bounds the load the collector puts on solr. Requests are admitted at most maxQueriesPerSecond (allowing
+    bursts of up to burst requests) and, when solr reports a QTime over qtimeThresholdMillis, the next requests are
+    delayed by an exponential back-off which is released again as responses get faster. A value of 0 disables each
+    mechanism. Shared by every thread querying solr, so it is thread safe """
+    def __init__(self, maxQueriesPerSecond=0, burst=1, qtimeThresholdMillis=0, maxBackoffSeconds=DEFAULT_MAX_BACKOFF_SECONDS):
+        self._interval = 1.0 / maxQueriesPerSecond if maxQueriesPerSecond > 0 else 0.0
+        self._burst = max(int(burst), 1)
+        self._qtimeThresholdMillis = qtimeThresholdMillis
+        self._maxBackoffSeconds = maxBackoffSeconds
+        self._lock = threading.Lock()
+
+        # theoretical arrival time of the next request (generic cell rate algorithm, equivalent to a token bucket)
+        self._nextArrival = 0.0
+        self._backoff = 0.0
+        self._notBefore = 0.0
+
+        self._requests = 0
+        self._slowResponses = 0
+        self._waited = 0.0
+
+    def acquire(self):
+        """ Blocks until the next request is allowed """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._notBefore)
+
+            if self._interval > 0:
+                nextArrival = max(self._nextArrival, now)
+                start = max(start, nextArrival - (self._burst - 1) * self._interval)
+                self._nextArrival = max(nextArrival, start) + self._interval
+
+            self._requests += 1
+            wait = start - now
+            if wait > 0:
+                self._waited += wait
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def observe(self, qtimeMillis):
+        """ Adjusts the back-off with the QTime reported by solr for a request """
+        if self._qtimeThresholdMillis <= 0 or qtimeMillis is None:
+            return
+
+        with self._lock:
+            if qtimeMillis > self._qtimeThresholdMillis:
+                self._slowResponses += 1
+                self._backoff = min(max(self._backoff * 2, BACKOFF_INITIAL_SECONDS), self._maxBackoffSeconds)
+                logger.info('SOLR_INPUT:: QTime {}ms over {}ms, backing off {:.1f}s'.format(qtimeMillis, self._qtimeThresholdMillis, self._backoff))
+            elif self._backoff > 0:
+                self._backoff = self._backoff / 2 if self._backoff > BACKOFF_INITIAL_SECONDS else 0.0
+            else:
+                return
+
+            self._notBefore = time.monotonic() + self._backoff
+
+    def __str__(self):
+        return '{} requests, {} slow responses, {:.1f}s waited'.format(self._requests, self._slowResponses, self._waited)
@@ -10,23 +10,46 @@ logger = logging.getLogger()
 import datetime
 
 import json
+import time
 import pysolr
 
 try:
-    from .eventpipeline import Event
+    from .eventpipeline import Event, EventBatch
+    from .readahead import BackgroundIterator
+    from .solrtime import parseSolrTime
+    from .solrstream import streamSelect
+    from .solrpagesize import AdaptivePageSize
+    from .solrgovernor import SolrLoadGovernor
 except Exception: #ImportError
-    from eventpipeline import Event
+    from eventpipeline import Event, EventBatch
+    from readahead import BackgroundIterator
+    from solrtime import parseSolrTime
+    from solrstream import streamSelect
+    from solrpagesize import AdaptivePageSize
+    from solrgovernor import SolrLoadGovernor
 
 TIMESTAMP_PATTERN = "%Y-%m-%dT%H:%M:%S.%fZ"
 
+# solr default maxBooleanClauses is 1024
+ROBOTS_PREFILTER_MAX_EXCLUDED_AGENTS = 1000
+
 class SolrTimestampCursor(object):
     
     """ Implements the concept of timestamped cursor """
-    def __init__(self, solr, query, maxDaysToLookForEvents=30):
+    def __init__(self, solr, query, maxDaysToLookForEvents=30, uniqueKey='uid', skipGaps=False, streaming=False, pageSize=None, governor=None):
         """ Cursor initialization """
         self.solr = solr
         self.query = query
         self.maxDaysToLookForEvents = maxDaysToLookForEvents
+        self.uniqueKey = uniqueKey
+        # if True, empty windows are skipped asking solr for the next event timestamp instead of looking ahead day by day
+        self.skipGaps = skipGaps
+        # if True, responses are parsed while they are read and pages are handed out in chunks of docs
+        self.streaming = streaming
+        # if given, an AdaptivePageSize choosing the rows of each request instead of the fixed rows
+        self.pageSize = pageSize
+        # SolrLoadGovernor throttling every request, shared with the other cursors
+        self.governor = governor if governor is not None else SolrLoadGovernor()
 
     def fetch(self, rows=500, limit=None, initialTimestamp=None, untilDate=None):
         """ Generator method that grabs all the documents in bulk sets of
@@ -48,8 +71,14 @@ class SolrTimestampCursor(object):
         # this counts the number of days we will look ahead from fromTimestamp
         daysToLookAhead = 1
 
+        # when skipping gaps, the end of the window containing the next event found after an empty window
+        nextEventWindowEnd = None
+
         while not done:
 
+            if self.pageSize is not None:
+                rows = self.pageSize.rows
+
              # limit the number of rows to the number of documents left to retrieve
             if limit is not None:
                 rows = min(rows, limit - docs_retrieved)
@@ -58,23 +87,48 @@ class SolrTimestampCursor(object):
             if untilDate is None:
                 # we look ahead for the number of days specified in daysToLookAhead counting from fromTimestamp
                 toTimeStamp = fromTimestamp + ('+%sDAYS' % daysToLookAhead) 
+
+                # unless we are jumping over a gap, then the window ends the day after the next event
+                if nextEventWindowEnd is not None:
+                    toTimeStamp = nextEventWindowEnd
             else: # otherwise, we need to set up the toTimeStamp to the untilDate
                 logger.debug('Until date is fixed looking events until %s' % untilDate)
                 toTimeStamp = untilDate
 
             # query solr    
             logger.debug('Fetching {} SOLR docs from timestamp: {} to timestamp {}'.format(rows, fromTimestamp, toTimeStamp))
-            docs = self._query_solr(fromTimestamp, toTimeStamp, rows)
-            numDocs = len(docs)
+            # every page (or chunk of a streamed page) updates the docs_retrieved count and the lastGoodFromTimestamp, then we yield the documents
+            numDocs = 0
+            for docs in self._query_solr(fromTimestamp, toTimeStamp, rows):
+                numDocs += len(docs)
+                docs_retrieved += len(docs)
+                lastGoodFromTimestamp = docs[-1]['time'] # update the lastGoodFromTimestamp to the timestamp of the last document
+                yield docs
  
-            # if we have retrieved any documents, then we need to update the docs_retrieved count, also update fromTimestamp to the timestamp of the last document
-            # and we need to reset the retryToLookAhead counter, then we yield the documents
+            # if we have retrieved any documents, then we need to update fromTimestamp to the timestamp of the last document
+            # and we need to reset the retryToLookAhead counter
             if numDocs > 0:
-                docs_retrieved += numDocs
-                lastGoodFromTimestamp = docs[-1]['time'] # update the lastGoodFromTimestamp to the timestamp of the last document
                 fromTimestamp = lastGoodFromTimestamp # update the fromTimestamp to the lastGoodFromTimestamp
                 retryToLookAhead = 0
-                yield docs
+                nextEventWindowEnd = None
+
+            elif self.skipGaps and untilDate is None and nextEventWindowEnd is None and (limit is None or docs_retrieved < limit):
+                # if we did not found any documents, ask solr for the timestamp of the next event after the last good timestamp
+                fromTimestamp = lastGoodFromTimestamp
+                nextTimestamp = self._query_next_timestamp(lastGoodFromTimestamp)
+
+                if nextTimestamp is None:
+                    logger.debug('SOLR Query found no events after %s, we are done' % lastGoodFromTimestamp)
+                    done = True
+                else:
+                    # the next window keeps lastGoodFromTimestamp as (exclusive) start and ends one day after the next event
+                    logger.debug('SOLR Query skipping gap from %s to next event at %s' % (lastGoodFromTimestamp, nextTimestamp))
+                    nextEventWindowEnd = nextTimestamp + ('+%sDAYS' % daysToLookAhead)
+
+            elif self.skipGaps and untilDate is None:
+                # the window of the next event was empty too (or the limit was reached)
+                done = True
+
             else: # if we did not found any documents
                 # we restore the last good fromTimestamp, because if we moved forward in time without succes we need restore the last good timestamp in order to avoid cumulative day offsets
                 fromTimestamp = lastGoodFromTimestamp
@@ -92,7 +146,7 @@ class SolrTimestampCursor(object):
                 # finally we consider an special case, if the lastGoodFromTimestamp + retyToLookAhead is greater than present moment then we are done
                 try:
                     # example 2022-10-17T08:36:03.879Z
-                    parsedate = datetime.datetime.strptime(str(lastGoodFromTimestamp), TIMESTAMP_PATTERN)
+                    parsedate = parseSolrTime(str(lastGoodFromTimestamp))
                     parsedate = parsedate + datetime.timedelta(days=retryToLookAhead)   
                     
                     if parsedate > datetime.datetime.now(): 
@@ -105,7 +159,121 @@ class SolrTimestampCursor(object):
 
 
         
-       
+    def fetchWithCursorMark(self, rows=500, limit=None, initialTimestamp=None, initialUid=None, untilDate=None):
+        """ Generator method that streams all the documents after (initialTimestamp, initialUid) using solr
+        cursorMark deep paging sorted by time and unique key, so events sharing a timestamp are neither skipped
+        nor sent twice
+        :param rows: number of rows for each request
+        """
+
+        query = self._checkpointQuery(initialTimestamp, initialUid, untilDate)
+        query.pop('start', None) # cursorMark does not allow start offsets
+        query['sort'] = 'time asc,%s asc' % self.uniqueKey
+
+        docs_retrieved = 0
+        cursorMark = '*'
+
+        while True:
+
+            if self.pageSize is not None:
+                rows = self.pageSize.rows
+
+            # limit the number of rows to the number of documents left to retrieve
+            if limit is not None:
+                rows = min(rows, limit - docs_retrieved)
+                if rows <= 0:
+                    break
+
+            query['rows'] = rows
+            query['cursorMark'] = cursorMark
+
+            logger.debug('Fetching {} SOLR docs from timestamp: {} uid: {} cursorMark: {}'.format(rows, initialTimestamp, initialUid, cursorMark))
+            (pages, resp_data) = self._select_docs(query)
+
+            numDocs = 0
+            for docs in pages:
+                numDocs += len(docs)
+                docs_retrieved += len(docs)
+                yield docs
+
+            # solr returns the same cursorMark when there are no more documents
+            nextCursorMark = resp_data.get('nextCursorMark', cursorMark)
+            if nextCursorMark == cursorMark or numDocs == 0:
+                break
+            cursorMark = nextCursorMark
+
+    def fetchWithExportHandler(self, limit=None, initialTimestamp=None, initialUid=None, untilDate=None, chunkSize=500, sortByUniqueKey=True):
+        """ Generator method that streams all the documents after (initialTimestamp, initialUid) in a single request
+        to the solr /export handler, which reads the sorted result set from docValues instead of paging through it.
+        Every field in fl and sort must have docValues
+        :param chunkSize: number of documents yielded together
+        """
+
+        query = self._checkpointQuery(initialTimestamp, initialUid, untilDate)
+        query.pop('start', None) # the whole result set is exported
+        query['sort'] = 'time asc,%s asc' % self.uniqueKey if sortByUniqueKey else 'time asc'
+
+        logger.debug('Exporting SOLR docs from timestamp: {} uid: {} to timestamp: {}'.format(initialTimestamp, initialUid, untilDate))
+        self.governor.acquire()
+        response = streamSelect(self.solr, query, handler='export')
+
+        docs_retrieved = 0
+        for docs in response.chunks(chunkSize):
+
+            # errors found once the export started are reported inside the stream
+            for doc in docs:
+                if 'EXCEPTION' in doc:
+                    raise pysolr.SolrError('Solr export handler failed: %s' % doc['EXCEPTION'])
+
+            # the limit is applied here, the export handler has no rows parameter
+            if limit is not None and docs_retrieved + len(docs) >= limit:
+                yield docs[:limit - docs_retrieved]
+                return
+
+            docs_retrieved += len(docs)
+            yield docs
+
+    def count(self, initialTimestamp=None, initialUid=None, untilDate=None):
+        """ Returns the number of documents after (initialTimestamp, initialUid), using a single rows=0 query """
+        query = self._checkpointQuery(initialTimestamp, initialUid, untilDate)
+        query.pop('sort', None)
+        query['rows'] = 0
+
+        self.governor.acquire()
+        resp_data = json.loads(self.solr._select(query))
+        self.governor.observe(resp_data.get('responseHeader', {}).get('QTime'))
+
+        return resp_data['response']['numFound']
+
+    def _checkpointQuery(self, initialTimestamp, initialUid, untilDate):
+        """ Returns a copy of the query restricted to the events after (initialTimestamp, initialUid) up to untilDate """
+        query = self.query.copy()
+
+        untilTimestamp = '"%s"' % untilDate if untilDate is not None else '*'
+        timeRange = 'time:{"%s" TO %s]' % (initialTimestamp, untilTimestamp)
+
+        # the checkpoint is (timestamp, uid), events with the same timestamp and a greater uid are still pending
+        if initialUid is not None:
+            timeRange = '(%s OR (time:"%s" AND %s:{"%s" TO *]))' % (timeRange, initialTimestamp, self.uniqueKey, initialUid.replace('"', '\\"'))
+
+        query['q'] = self.query.get('q', '*') + ' +' + timeRange
+        return query
+
+    def _query_next_timestamp(self, fromTimestamp):
+        """ Returns the timestamp of the first event after fromTimestamp, None if there are no events """
+        query = self.query.copy()
+        query['q'] = self.query.get('q','*') + (' +time:{"%s" TO *]' % fromTimestamp)
+        query['sort'] = 'time asc'
+        query['fl'] = 'time'
+        query['rows'] = 1
+
+        self.governor.acquire()
+        resp_data = json.loads(self.solr._select(query))
+        self.governor.observe(resp_data.get('responseHeader', {}).get('QTime'))
+
+        docs = resp_data['response']['docs']
+        return docs[0]['time'] if len(docs) > 0 else None
+
     def _query_solr(self, fromTimestamp, toTimeStamp, rows):
         
         # copy the query and add the time range
@@ -113,14 +281,52 @@ class SolrTimestampCursor(object):
         query['q'] = self.query.get('q','*') + (' +time:{"%s" TO "%s"]' % (fromTimestamp, toTimeStamp))
         query['rows'] = rows
         
-        # query solr
-        results = self.solr._select(query)
-        
+        # query solr, return the documents
+        (pages, resp_data) = self._select_docs(query)
+        return pages
+
+    def _select_docs(self, query):
+        """ Runs the query, returns the docs as an iterable of non empty lists and the response dict. When streaming,
+        the response dict is complete (nextCursorMark, ...) once the docs have been consumed """
+        self.governor.acquire()
+
+        if self.streaming:
+            start = time.monotonic()
+            response = streamSelect(self.solr, query)
+            return (self._observedChunks(query, response, time.monotonic() - start), response.header)
+
+        start = time.monotonic()
+        text = self.solr._select(query)
+        elapsed = time.monotonic() - start
+
         # convert the results to json object
-        resp_data = json.loads(results)
-        
-        # return the documents
-        return resp_data['response']['docs']
+        resp_data = json.loads(text)
+        docs = resp_data['response']['docs']
+        self._observe(query, len(docs), elapsed, resp_data, len(text))
+
+        return ([docs] if len(docs) > 0 else [], resp_data)
+
+    def _observedChunks(self, query, response, elapsed):
+        """ Generator of the chunks of a streamed response, the time spent reading them (not the time the consumer
+        spends between chunks) is reported to the page size once the response is consumed """
+        numDocs = 0
+        start = time.monotonic()
+        for docs in response.chunks():
+            elapsed += time.monotonic() - start
+            numDocs += len(docs)
+            yield docs
+            start = time.monotonic()
+        elapsed += time.monotonic() - start
+
+        self._observe(query, numDocs, elapsed, response.header, response.bytesRead)
+
+    def _observe(self, query, numDocs, elapsed, resp_data, numBytes):
+        """ Reports the cost of a select request to the governor and the page size """
+        qtime = resp_data.get('responseHeader', {}).get('QTime')
+        self.governor.observe(qtime)
+
+        if self.pageSize is not None:
+            self.pageSize.observe(query['rows'], numDocs, elapsed * 1000, qtime, numBytes)
 
 class SolrStatisticsInput:
 
@@ -131,21 +337,33 @@ class SolrStatisticsInput:
         self._initialTimestamp = configContext.solrQueryInitialTimestamp
         self._untilDate = configContext.solrQueryUntilDate
         self._solrServerURL = configContext.solrStatsCoreURL
+        self._configContext = configContext
+        self._initialUid = configContext.solrQueryInitialUid
+        self._pagingMode = configContext.solrPagingMode
+        self._uniqueKey = configContext.solrUniqueKey
+        self._useExportHandler = False
 
-    def run(self):
-        solr = pysolr.Solr(self._solrServerURL, timeout=600)
-        cursor = SolrTimestampCursor(solr, {
-            'q': '*',
-            'sort': 'time asc',
-            'start': 0,
-            'wt': 'json',
-            'fq': '+statistics_type:"view" +type:(0 OR 2) +isBot:false',
-            'fl': 'id,ip,owningItem,referrer,time,type,userAgent'
-        })
-        
+        # solr connection and query, set up by prepare
+        self._solr = None
+        self._query = None
+
+        # with adaptive paging every cursor (one per time shard) shares the page size
+        if configContext.solrAdaptiveRows:
+            self._pageSize = AdaptivePageSize(self._rows, configContext.solrMinRows, configContext.solrMaxRows,
+                                              configContext.solrTargetMillis, configContext.solrMaxPageBytes)
+        else:
+            self._pageSize = None
+
+        # every request to solr, from any thread, goes through the same governor
+        self._governor = SolrLoadGovernor(configContext.solrMaxQueriesPerSecond, configContext.solrQueriesBurst,
+                                          configContext.solrQTimeThresholdMillis, configContext.solrMaxBackoffSeconds)
 
+    def _newSolr(self):
+        return pysolr.Solr(self._solrServerURL, timeout=600)
+
+    def run(self):
         n = 0
-        for docs in cursor.fetch(rows=self._rows, limit=self._limit, initialTimestamp = self._initialTimestamp, untilDate = self._untilDate):
+        for docs in self._pages():
 
             logger.debug('{} SOLR docs retrieved. Converting docs to events'.format(len(docs)))
 
@@ -153,6 +371,7 @@ class SolrStatisticsInput:
                 event = Event()
                 event._id = n
                 event._src = doc
+                event._time = parseSolrTime(doc['time'])
                 n = n + 1 
 
                 if 'userAgent' not in doc.keys():
@@ -161,3 +380,271 @@ class SolrStatisticsInput:
                 logger.debug('SOLR_INPUT:: Event: {}'.format(event._id))
 
                 yield event
+
+        self._logPageSize()
+
+    def runBatches(self):
+        """ Batch mode, yields every solr page as an EventBatch """
+        n = 0
+        for docs in self._pages():
+
+            logger.debug('{} SOLR docs retrieved. Converting docs to batch'.format(len(docs)))
+
+            for doc in docs:
+                if 'userAgent' not in doc:
+                    doc['userAgent'] = None
+
+            batch = EventBatch(n, docs)
+            batch.times = [ parseSolrTime(doc['time']) for doc in docs ]
+            n = n + len(docs)
+
+            yield batch
+
+        self._logPageSize()
+
+    def _logPageSize(self):
+        if self._pageSize is not None:
+            logger.info('SOLR_INPUT:: Adaptive page size {}'.format(self._pageSize))
+        logger.debug('SOLR_INPUT:: Load governor {}'.format(self._governor))
+
+    def hasPendingEvents(self):
+        """ Cheap check for events after the checkpoint, so idle runs can finish without building the pipeline """
+        # timestamp paging does not use the uid of the checkpoint
+        initialUid = self._initialUid if self._pagingMode == 'cursor' else None
+
+        cursor = SolrTimestampCursor(self._newSolr(), self._baseQuery(), uniqueKey=self._uniqueKey, governor=self._governor)
+        pending = cursor.count(self._initialTimestamp, initialUid, self._untilDate)
+        logger.debug('SOLR_INPUT:: {} events pending after {} uid: {}'.format(pending, self._initialTimestamp, initialUid))
+
+        return pending > 0
+
+    def _baseQuery(self):
+        return {
+            'q': '*',
+            'sort': 'time asc',
+            'start': 0,
+            'wt': 'json',
+            'fq': '+statistics_type:"view" +type:(0 OR 2) +isBot:false',
+            'fl': 'id,ip,owningItem,referrer,time,type,userAgent'
+        }
+
+    def prepare(self):
+        """ Sets up the solr query before events start flowing. The robots prefilter verdicts are computed here, so
+        they are already in the robots matcher when filters are copied to worker processes """
+        if self._solr is not None:
+            return
+
+        self._solr = self._newSolr()
+        self._query = self._baseQuery()
+
+        if self._configContext.solrRobotsPrefilter:
+            self._prefilterRobots(self._solr, self._query)
+
+        if self._pagingMode == 'cursor':
+            self._query['fl'] = self._query['fl'] + ',' + self._uniqueKey
+
+        if self._configContext.solrExportHandler:
+            self._useExportHandler = self._exportHandlerSupported(self._solr, self._query)
+
+    def _pages(self):
+        """ Returns the iterator of solr pages (lists of docs) """
+        self.prepare()
+        solr = self._solr
+        query = self._query
+
+        fetchThreads = self._configContext.solrFetchThreads
+
+        # backfills with a fixed until date can be fetched in parallel time shards
+        if fetchThreads > 1 and self._untilDate is not None:
+            return self._fetchSharded(solr, query, fetchThreads)
+
+        pages = self._fetch(solr, query, self._initialTimestamp, self._initialUid, self._untilDate, self._limit)
+
+        # the next pages are fetched in background while the pipeline processes the current one
+        if self._configContext.solrPrefetchPages > 0:
+            pages = BackgroundIterator(pages, self._configContext.solrPrefetchPages, name='solr-prefetch')
+
+        return pages
+
+    def _fetch(self, solr, query, initialTimestamp, initialUid, untilDate, limit):
+        """ Returns the generator of pages for the configured paging mode """
+        cursor = SolrTimestampCursor(solr, query, uniqueKey=self._uniqueKey, skipGaps=self._configContext.solrSkipGaps, streaming=self._configContext.solrStreaming, pageSize=self._pageSize, governor=self._governor)
+
+        if self._useExportHandler:
+            return self._fetchExported(cursor, initialTimestamp, initialUid, untilDate, limit)
+        else:
+            return self._fetchPaged(cursor, initialTimestamp, initialUid, untilDate, limit)
+
+    def _fetchPaged(self, cursor, initialTimestamp, initialUid, untilDate, limit):
+        if self._pagingMode == 'cursor':
+            return cursor.fetchWithCursorMark(rows=self._rows, limit=limit, initialTimestamp=initialTimestamp, initialUid=initialUid, untilDate=untilDate)
+        else:
+            return cursor.fetch(rows=self._rows, limit=limit, initialTimestamp=initialTimestamp, untilDate=untilDate)
+
+    def _fetchExported(self, cursor, initialTimestamp, initialUid, untilDate, limit):
+        """ Generator of the pages read from the export handler, falls back to paging if the export request is rejected """
+        pages = cursor.fetchWithExportHandler(limit=limit, initialTimestamp=initialTimestamp, initialUid=initialUid, untilDate=untilDate,
+                                              chunkSize=self._rows, sortByUniqueKey=(self._pagingMode == 'cursor'))
+        try:
+            first = next(pages, None)
+        except (pysolr.SolrError, IOError) as e:
+            logger.warning('SOLR export handler request failed, falling back to paging. Error was: {}'.format(e))
+            yield from self._fetchPaged(cursor, initialTimestamp, initialUid, untilDate, limit)
+            return
+
+        if first is not None:
+            yield first
+            yield from pages
+
+    def _exportHandlerSupported(self, solr, query):
+        """ Checks with the schema api that every exported or sorted field has docValues, as the export handler requires """
+        fields = set(query['fl'].split(',') + ['time'])
+
+        try:
+            schema = dict( (field['name'], field) for field in self._schemaFields(solr) )
+        except Exception as e:
+            logger.info('Could not read the SOLR schema, export handler disabled. Error was: {}'.format(e))
+            return False
+
+        missing = [ name for name in sorted(fields) if not schema.get(name, {}).get('docValues', False) ]
+        if len(missing) > 0:
+            logger.info('SOLR fields without docValues: {}, export handler disabled'.format(', '.join(missing)))
+            return False
+
+        # the export handler can not sort on multivalued fields
+        if schema['time'].get('multiValued', False):
+            logger.info('SOLR time field is multivalued, export handler disabled')
+            return False
+
+        logger.debug('SOLR_INPUT:: Using the export handler')
+        return True
+
+    def _fetchSharded(self, solr, query, numShards):
+        """ Splits the time range in shards with a similar number of events, fetches them concurrently (one thread
+        and solr connection per shard, each one buffering up to solrFetchBufferPages pages) and yields the pages in timestamp order """
+        boundaries = self._splitTimeRange(solr, query, numShards)
+        logger.debug('SOLR_INPUT:: Fetching {} time shards in parallel: {}'.format(len(boundaries) - 1, boundaries))
+
+        # shards are contiguous and disjoint: (b0, b1], (b1, b2], ... so yielding them in sequence keeps the order
+        shards = []
+        for i in range(len(boundaries) - 1):
+            initialUid = self._initialUid if i == 0 else None
+            pages = self._fetch(self._newSolr(), query, boundaries[i], initialUid, boundaries[i + 1], None)
+            shards.append(BackgroundIterator(pages, self._configContext.solrFetchBufferPages, name='solr-shard-%d' % i))
+
+        docs_retrieved = 0
+        try:
+            for shard in shards:
+                for docs in shard:
+                    if self._limit is not None and docs_retrieved + len(docs) >= self._limit:
+                        yield docs[:self._limit - docs_retrieved]
+                        return
+                    docs_retrieved += len(docs)
+                    yield docs
+        finally:
+            for shard in shards:
+                shard.close()
+
+    def _splitTimeRange(self, solr, query, numShards):
+        """ Returns numShards + 1 timestamps splitting (initialTimestamp, untilDate] in ranges with a similar number of
+        events, based on a range facet count per day (per hour for short ranges) """
+        fromDate = datetime.datetime.strptime(self._initialTimestamp, TIMESTAMP_PATTERN)
+        untilDate = datetime.datetime.strptime(self._untilDate, TIMESTAMP_PATTERN)
+        gap = '+1HOUR' if untilDate - fromDate <= datetime.timedelta(days=3) else '+1DAY'
+
+        facetQuery = {
+            'q': query['q'] + (' +time:{"%s" TO "%s"]' % (self._initialTimestamp, self._untilDate)),
+            'fq': query['fq'],
+            'rows': 0,
+            'wt': 'json',
+            'facet': 'true',
+            'facet.range': 'time',
+            'facet.range.start': self._initialTimestamp,
+            'facet.range.end': self._untilDate,
+            'facet.range.gap': gap,
+            'facet.mincount': 0
+        }
+
+        try:
+            resp_data = self._selectFacets(solr, facetQuery)
+            # flat list [bucketStart, count, bucketStart, count, ...]
+            counts = resp_data['facet_counts']['facet_ranges']['time']['counts']
+            buckets = list(zip(counts[0::2], counts[1::2]))
+
+            total = sum(count for (bucket, count) in buckets)
+            boundaries = [self._initialTimestamp]
+            accumulated = 0
+            for (bucket, count) in buckets:
+                # a new shard starts at this bucket once the previous ones hold their share of events
+                if total > 0 and accumulated >= total * len(boundaries) / numShards and len(boundaries) < numShards and accumulated > 0:
+                    # buckets start at facet.range.start, so they carry its milliseconds
+                    boundaries.append(parseSolrTime(bucket).strftime(TIMESTAMP_PATTERN))
+                accumulated += count
+            boundaries.append(self._untilDate)
+        except Exception as e:
+            logger.error('Could not retrieve time range facets from solr, fetching in a single shard. Error was: {}'.format(e))
+            return [self._initialTimestamp, self._untilDate]
+
+        return boundaries
+
+    def _selectFacets(self, solr, facetQuery):
+        return self._governedRequest(lambda: json.loads(solr._select(facetQuery)))
+
+    def _schemaFields(self, solr):
+        def request():
+            response = solr.get_session().get(solr.url + '/schema/fields', params={'showDefaults': 'true', 'wt': 'json'}, timeout=solr.timeout)
+            response.raise_for_status()
+            return response.json()
+
+        return self._governedRequest(request)['fields']
+
+    def _governedRequest(self, request):
+        """ Runs a request to solr returning the response dict, throttled by the load governor """
+        self._governor.acquire()
+        resp_data = request()
+        self._governor.observe(resp_data.get('responseHeader', {}).get('QTime'))
+        return resp_data
+
+    def _prefilterRobots(self, solr, query):
+        """ Asks solr for the distinct user agents of the events to be processed and classifies each one once,
+        so the robots filter does not need to match them. Optionally robot user agents are excluded in the query """
+
+        maxAgents = self._configContext.solrRobotsPrefilterMaxAgents
+        untilDate = '"%s"' % self._untilDate if self._untilDate is not None else '*'
+
+        facetQuery = {
+            'q': query['q'] + (' +time:{"%s" TO %s]' % (self._initialTimestamp, untilDate)),
+            'fq': query['fq'],
+            'rows': 0,
+            'wt': 'json',
+            'facet': 'true',
+            'facet.field': 'userAgent',
+            'facet.limit': maxAgents + 1,
+            'facet.mincount': 1
+        }
+
+        try:
+            resp_data = self._selectFacets(solr, facetQuery)
+            # flat list [agent, count, agent, count, ...] sorted by count
+            userAgents = resp_data['facet_counts']['facet_fields']['userAgent'][0::2]
+        except Exception as e:
+            logger.error('Could not retrieve user agent facets from solr, robots prefilter disabled. Error was: {}'.format(e))
+            return
+
+        if len(userAgents) > maxAgents:
+            logger.info('More than {} distinct user agents to process, robots prefilter disabled'.format(maxAgents))
+            return
+
+        verdicts = self._configContext.getRobotsMatcher().classify(userAgents)
+        robots = [ userAgent for userAgent in userAgents if verdicts[userAgent] ]
+        logger.debug('SOLR_INPUT:: {} distinct user agents classified, {} robots'.format(len(userAgents), len(robots)))
+
+        if self._configContext.solrRobotsPrefilterExclude and len(robots) > 0:
+            # the most frequent robots come first
+            excluded = robots[:ROBOTS_PREFILTER_MAX_EXCLUDED_AGENTS]
+            query['fq'] = query['fq'] + ' -userAgent:(' + ' OR '.join( '"%s"' % self._escapePhrase(userAgent) for userAgent in excluded ) + ')'
+            logger.debug('SOLR_INPUT:: {} robot user agents excluded in solr query'.format(len(excluded)))
+
+    @staticmethod
+    def _escapePhrase(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"')
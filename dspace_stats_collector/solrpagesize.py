@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Adaptive size of solr pages """
+
+import logging
+logger = logging.getLogger()
+
+import threading
+
+DEFAULT_MIN_ROWS = 100
+DEFAULT_MAX_ROWS = 5000
+DEFAULT_TARGET_MILLIS = 1000
+DEFAULT_MAX_PAGE_BYTES = 16 * 1024 * 1024
+
+# the page size changes at most by this factor from one request to the next
+MAX_STEP_FACTOR = 2.0
+
+
+class AdaptivePageSize:
+
+    """ Chooses the rows of the next solr request from the cost observed in the previous ones. The time of a request
+    is modeled as the solr QTime (searching and sorting, mostly independent of rows) plus a transfer and parsing cost
+    per document, and rows are chosen so the whole request takes about targetMillis and the page stays under
+    maxPageBytes. Shared by every cursor of the input, so it is thread safe """
+    def __init__(self, rows, minRows=DEFAULT_MIN_ROWS, maxRows=DEFAULT_MAX_ROWS, targetMillis=DEFAULT_TARGET_MILLIS, maxPageBytes=DEFAULT_MAX_PAGE_BYTES):
+        self._minRows = max(int(minRows), 1)
+        self._maxRows = max(int(maxRows), self._minRows)
+        self._targetMillis = float(targetMillis)
+        self._maxPageBytes = maxPageBytes
+        self._rows = min(max(int(rows), self._minRows), self._maxRows)
+        self._lock = threading.Lock()
+        self._requests = 0
+
+    @property
+    def rows(self):
+        return self._rows
+
+    def observe(self, requestedRows, numDocs, elapsedMillis, qtimeMillis, numBytes):
+        """ Updates the page size with the cost of a request returning numDocs of the requestedRows """
+        # a short page (end of a time window, or of the events) is dominated by the request overhead and says
+        # nothing about the cost of larger pages
+        if numDocs <= 0 or numDocs < requestedRows:
+            return
+
+        # the time not spent by solr searching is spent transferring and parsing docs
+        qtimeMillis = min(qtimeMillis or 0, elapsedMillis)
+        millisPerDoc = max(elapsedMillis - qtimeMillis, 1.0) / numDocs
+        bytesPerDoc = max(numBytes, 1) / numDocs
+
+        estimate = (self._targetMillis - qtimeMillis) / millisPerDoc
+        estimate = min(estimate, self._maxPageBytes / bytesPerDoc)
+
+        with self._lock:
+            self._requests += 1
+            current = self._rows
+            rows = int(min(max(estimate, current / MAX_STEP_FACTOR), current * MAX_STEP_FACTOR))
+            rows = min(max(rows, self._minRows), self._maxRows)
+
+            if rows != current:
+                self._rows = rows
+                logger.debug('SOLR_INPUT:: page size {} -> {} (QTime {:.0f}ms, request {:.0f}ms, {} bytes for {} docs)'.format(
+                    current, rows, qtimeMillis, elapsedMillis, numBytes, numDocs))
+
+    def __str__(self):
+        return 'rows: {} after {} requests, bounds [{}, {}], target {:.0f}ms'.format(self._rows, self._requests, self._minRows, self._maxRows, self._targetMillis)
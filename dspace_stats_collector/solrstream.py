@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Streaming parsing of Solr json responses """
+
+import logging
+logger = logging.getLogger()
+
+import codecs
+import json
+
+import pysolr
+
+# bytes read from the http response at a time
+STREAM_READ_SIZE = 64 * 1024
+
+# docs handed out together while parsing a response
+STREAM_CHUNK_DOCS = 500
+
+_WHITESPACE = ' \t\n\r'
+
+
+class SolrStreamingResponse:
+
+    """ Incremental parser of a solr json response read as a sequence of bytes chunks. The docs of response.docs are
+    decoded one by one as the bytes arrive, so the whole body is never held in memory. Every other entry of the
+    response (responseHeader, response.numFound, nextCursorMark, ...) is collected in header, complete once the
+    docs have been consumed """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._textDecoder = codecs.getincrementaldecoder('utf-8')()
+        self._jsonDecoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self.header = {}
+        self.bytesRead = 0
+
+    def docs(self):
+        """ Generator of the docs of the response """
+        self._expect('{')
+        while not self._consume('}'):
+            key = self._value()
+            self._expect(':')
+
+            if key == 'response' and self._peek() == '{':
+                yield from self._responseDocs()
+            else:
+                self.header[key] = self._value()
+
+            self._consume(',')
+
+    def chunks(self, size=STREAM_CHUNK_DOCS):
+        """ Generator of lists of up to size docs """
+        chunk = []
+        for doc in self.docs():
+            chunk.append(doc)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def _responseDocs(self):
+        response = self.header.setdefault('response', {})
+
+        self._expect('{')
+        while not self._consume('}'):
+            key = self._value()
+            self._expect(':')
+
+            if key == 'docs' and self._peek() == '[':
+                self._expect('[')
+                while not self._consume(']'):
+                    yield self._value()
+                    self._consume(',')
+            else:
+                response[key] = self._value()
+
+            self._consume(',')
+
+    def _fill(self):
+        """ Reads the next chunk into the buffer, returns False at the end of the stream """
+        if self._eof:
+            return False
+
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+
+        for chunk in self._chunks:
+            self.bytesRead += len(chunk)
+            text = self._textDecoder.decode(chunk)
+            if text:
+                self._buffer += text
+                return True
+
+        self._buffer += self._textDecoder.decode(b'', final=True)
+        self._eof = True
+        return False
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of solr response')
+
+    def _consume(self, char):
+        if self._peek() == char:
+            self._pos += 1
+            return True
+        return False
+
+    def _expect(self, char):
+        if not self._consume(char):
+            raise ValueError('Unexpected character {} in solr response, expected {}'.format(self._peek(), char))
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                (value, end) = self._jsonDecoder.raw_decode(self._buffer, self._pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            self._fill()
+
+
+def streamSelect(solr, query, handler='select'):
+    """ Runs a query against a request handler (select, export) reading the response as a stream.
+    :return: SolrStreamingResponse, the http response is closed once its docs are consumed
+    """
+    response = solr.get_session().post(solr.url + '/' + handler, data=query, stream=True, timeout=solr.timeout)
+
+    if response.status_code != 200:
+        message = response.text
+        response.close()
+        raise pysolr.SolrError("Solr responded with an error (HTTP %s): %s" % (response.status_code, message[:1000]))
+
+    def chunks():
+        try:
+            for chunk in response.iter_content(chunk_size=STREAM_READ_SIZE):
+                yield chunk
+        finally:
+            response.close()
+
+    return SolrStreamingResponse(chunks())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Solr timestamps parsing """
+
+import logging
+logger = logging.getLogger()
+
+import re
+from datetime import datetime
+from dateutil import parser as dateutil_parser
+from pytz import timezone
+
+# yyyy-mm-ddThh:mm:ss[.fraction]Z as stored by dspace
+ISO_TIMESTAMP_REGEX = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6})\d*)?Z?$')
+
+# events come sorted by time and many share the same second
+SECOND_MEMO_MAX_SIZE = 10000
+
+_seconds = {} # 'yyyy-mm-ddThh:mm:ss' -> datetime
+_matomoTimes = {} # datetime truncated to seconds -> matomo cdt string
+
+UTC = timezone('UTC')
+
+
+def parseSolrTime(timestamp):
+    """ Parses a solr timestamp into a naive datetime (the time as stored by dspace). Uses a fast path for iso
+    formatted timestamps, memoized per second, falling back to dateutil for anything else """
+
+    time = _seconds.get(timestamp[:19])
+    rest = timestamp[19:]
+
+    if time is not None and (rest == 'Z' or rest == ''):
+        return time
+
+    if time is not None and rest[:1] == '.' and rest[1:].rstrip('Z').isdigit():
+        return time.replace(microsecond=int(rest[1:].rstrip('Z')[:6].ljust(6, '0')))
+
+    m = ISO_TIMESTAMP_REGEX.match(timestamp)
+    if m is None:
+        return dateutil_parser.parse(timestamp).replace(tzinfo=None)
+
+    time = datetime(*[ int(value) for value in m.group(1, 2, 3, 4, 5, 6) ])
+    if len(_seconds) >= SECOND_MEMO_MAX_SIZE:
+        _seconds.clear()
+    _seconds[timestamp[:19]] = time
+
+    if m.group(7):
+        return time.replace(microsecond=int(m.group(7).ljust(6, '0')))
+    return time
+
+def toMatomoTime(time):
+    """ Returns the matomo cdt value (yyyy-mm-dd hh:mm:ss in UTC) of a parsed solr time """
+
+    second = time.replace(microsecond=0)
+    cdt = _matomoTimes.get(second)
+
+    if cdt is None:
+        try:  # if env locale is ok
+            utctime = second.astimezone(UTC)
+        except:  # otherwise (naive datetime without timezone yet), report solr time as utc without converting
+            utctime = UTC.localize(second)
+
+        cdt = datetime.strftime(utctime, "%Y-%m-%d %H:%M:%S")
+        if len(_matomoTimes) >= SECOND_MEMO_MAX_SIZE:
+            _matomoTimes.clear()
+        _matomoTimes[second] = cdt
+
+    return cdt
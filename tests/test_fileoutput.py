@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the collector archive output."""
+
+import gzip
+import os
+from datetime import datetime
+
+from dspace_stats_collector.configcontext import History
+from dspace_stats_collector.eventpipeline import Event
+from dspace_stats_collector.fileoutput import ArchiveOutput
+from dspace_stats_collector.outputdispatcher import OutputChannel, OutputDispatcher, _END
+
+
+class ConfigContext:
+
+    def __init__(self, archiveDir):
+        self.archiveDir = archiveDir
+        self.repoName = 'repo'
+        self.solrUniqueKey = 'uid'
+
+
+def makeEvent(n, time, is_robot=False):
+    event = Event()
+    event._id = n
+    event._time = time
+    event._src = {'uid': 'u%04d' % n}
+    event._matomoRequest = '?idsite=1&_id=%d' % n
+    event.is_robot = is_robot
+    return event
+
+
+def runCollector(configContext, history, events):
+    """ Runs the archive output as the collector does, resuming from the checkpoint of its history """
+    timestamp = history.get_last_tracked_timestamp()
+    checkpoint = (timestamp, history.get_last_tracked_uid()) if timestamp is not None else None
+    channel = OutputChannel('file', ArchiveOutput(configContext, history), checkpoint)
+
+    for event in events:
+        channel.queue.put(event)
+    channel.queue.put(_END)
+    channel.run()
+    return channel
+
+
+def readArchive(directory, name):
+    with gzip.open(os.path.join(directory, name), 'rt') as f:
+        return f.read().splitlines()
+
+
+def test_consecutive_runs_append_to_archive(tmp_path):
+    configContext = ConfigContext(str(tmp_path / 'archive'))
+    history = History(str(tmp_path / 'timestamp'), 'repo.file')
+
+    january = [ makeEvent(n, datetime(2024, 1, 10, 12, 0, n)) for n in range(5) ]
+    runCollector(configContext, history, january)
+
+    # the second run gets the events of the first one again (same solr window) plus new ones, one of them a robot
+    lateJanuary = [ makeEvent(n, datetime(2024, 1, 20, 12, 0, n)) for n in range(5, 7) ]
+    february = [ makeEvent(n, datetime(2024, 2, 1, 8, 0, n)) for n in range(7, 10) ]
+    robot = makeEvent(10, datetime(2024, 2, 1, 9, 0, 0), is_robot=True)
+    runCollector(configContext, History(str(tmp_path / 'timestamp'), 'repo.file'), january + lateJanuary + february + [robot])
+
+    assert readArchive(configContext.archiveDir, 'repo_2024_01.txt.gz') == [ event._matomoRequest for event in january + lateJanuary ]
+    assert readArchive(configContext.archiveDir, 'repo_2024_02.txt.gz') == [ event._matomoRequest for event in february ]
+
+
+def test_month_follows_event_time(tmp_path):
+    configContext = ConfigContext(str(tmp_path))
+
+    events = [ makeEvent(0, datetime(2023, 12, 31, 23, 59, 59)), makeEvent(1, datetime(2024, 1, 1, 0, 0, 0)) ]
+    ArchiveOutput(configContext).run(iter(events))
+
+    assert readArchive(str(tmp_path), 'repo_2023_12.txt.gz') == [ events[0]._matomoRequest ]
+    assert readArchive(str(tmp_path), 'repo_2024_01.txt.gz') == [ events[1]._matomoRequest ]
+
+
+def test_failed_run_keeps_checkpoint_of_archived_events(tmp_path):
+    configContext = ConfigContext(str(tmp_path / 'archive'))
+    history = History(str(tmp_path / 'timestamp'), 'repo.file')
+
+    january = [ makeEvent(n, datetime(2024, 1, 10, 12, 0, n)) for n in range(3) ]
+    february = [ makeEvent(n, datetime(2024, 2, 1, 8, 0, n)) for n in range(3, 6) ]
+
+    # the first run fails in the middle of february, after the january file was closed
+    broken = makeEvent(5, datetime(2024, 2, 1, 8, 0, 5))
+    broken._matomoRequest = None
+    channel = runCollector(configContext, history, january + february[:2] + [broken])
+
+    assert isinstance(channel.error, TypeError)
+    assert (history.get_last_tracked_timestamp(), history.get_last_tracked_uid()) == ('2024-02-01T08:00:04.000000Z', 'u0004')
+
+    # the next run resumes after the last archived event, nothing is appended twice
+    runCollector(configContext, History(str(tmp_path / 'timestamp'), 'repo.file'), january + february)
+
+    assert readArchive(configContext.archiveDir, 'repo_2024_01.txt.gz') == [ event._matomoRequest for event in january ]
+    assert readArchive(configContext.archiveDir, 'repo_2024_02.txt.gz') == [ event._matomoRequest for event in february ]
+
+
+class OfflineOutput:
+
+    def run(self, events):
+        for event in events:
+            raise ConnectionError('matomo is offline')
+
+
+def test_dispatcher_raises_output_errors_after_every_output_finished(tmp_path):
+    configContext = ConfigContext(str(tmp_path))
+    events = [ makeEvent(n, datetime(2024, 1, 10, 12, 0, n)) for n in range(20) ]
+
+    dispatcher = OutputDispatcher([ OutputChannel('matomo', OfflineOutput()), OutputChannel('file', ArchiveOutput(configContext)) ])
+    try:
+        dispatcher.run(iter(events))
+        assert False, 'the output error was not raised'
+    except ConnectionError:
+        pass
+
+    assert readArchive(str(tmp_path), 'repo_2024_01.txt.gz') == [ event._matomoRequest for event in events ]
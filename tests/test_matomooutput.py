@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the recovery of failed Matomo bulk requests."""
+
+import json
+
+import requests
+
+from dspace_stats_collector.eventpipeline import Event
+from dspace_stats_collector.matomooutput import MatomoOutput
+
+
+class History:
+
+    def __init__(self):
+        self.checkpoint = None
+
+    def save_last_tracked_timestamp(self, timestamp, uid=None):
+        self.checkpoint = (timestamp, uid)
+
+    def get_last_tracked_timestamp(self):
+        return self.checkpoint[0] if self.checkpoint is not None else None
+
+
+class ConfigContext:
+
+    solrUniqueKey = 'uid'
+    solrQueryInitialTimestamp = '2024-01-01T00:00:00.000Z'
+    matomoSpoolDir = None
+
+    def __init__(self, batchSize):
+        self.batchSize = batchSize
+        self.history = History()
+
+    def getMatomoUrl(self):
+        return 'http://matomo.invalid/matomo.php'
+
+    def getMatomoOutputSize(self):
+        return self.batchSize
+
+    def getMatomoConcurrentRequests(self):
+        return 1
+
+    def getMatomoTokenAuth(self):
+        return 'token'
+
+
+class Response:
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def raise_for_status(self):
+        if self.status_code != 200:
+            raise requests.exceptions.HTTPError('%d error' % self.status_code)
+
+
+class BulkSession:
+
+    """ Fake matomo bulk tracking endpoint, requests containing 'bad' are invalid. With reportInvalid the other
+    requests are tracked and the invalid ones reported in invalid_indices, otherwise the whole bulk request fails """
+    def __init__(self, reportInvalid):
+        self.reportInvalid = reportInvalid
+        self.tracked = []
+        self.posts = 0
+
+    def post(self, url, data):
+        self.posts += 1
+        bulk = json.loads(data)['requests']
+        invalid = [ i for (i, request) in enumerate(bulk) if 'bad' in request ]
+
+        if len(invalid) > 0 and not self.reportInvalid:
+            return Response(400, 'invalid request')
+
+        self.tracked.extend( request for request in bulk if 'bad' not in request )
+        body = {'status': 'success', 'tracked': len(bulk) - len(invalid), 'invalid': len(invalid)}
+        if len(invalid) > 0:
+            body['invalid_indices'] = invalid
+        return Response(200, json.dumps(body))
+
+    def close(self):
+        pass
+
+
+def makeEvents(n, bad):
+    events = []
+    for i in range(n):
+        event = Event()
+        event._src = {'time': '2024-01-01T00:00:%02d.000Z' % i, 'uid': 'u%04d' % i}
+        event._matomoRequest = '?idsite=1&_id=%d' % i + ('&bad=1' if i in bad else '')
+        event.is_robot = False
+        events.append(event)
+    return events
+
+
+def runOutput(configContext, session, events):
+    output = MatomoOutput(configContext)
+    output._sender._session.close()
+    output._sender._session = session
+    output.run(iter(events))
+    return output
+
+
+def test_invalid_indices_discard_only_the_reported_requests():
+    configContext = ConfigContext(10)
+    session = BulkSession(reportInvalid=True)
+    events = makeEvents(20, bad=[3, 14])
+
+    output = runOutput(configContext, session, events)
+
+    assert session.tracked == [ event._matomoRequest for event in events if 'bad' not in event._matomoRequest ]
+    assert session.posts == 2
+    assert output._sender.getTotalSent() == 18
+    assert configContext.history.checkpoint == ('2024-01-01T00:00:19.000Z', 'u0019')
+
+
+def test_failed_bulk_request_is_bisected():
+    configContext = ConfigContext(16)
+    session = BulkSession(reportInvalid=False)
+    events = makeEvents(16, bad=[5])
+
+    output = runOutput(configContext, session, events)
+
+    assert session.tracked == [ event._matomoRequest for event in events if 'bad' not in event._matomoRequest ]
+    # the failed request plus two halves per level, instead of one request per event
+    assert session.posts == 1 + 2 * 4
+    assert output._sender.getTotalSent() == 15
+    assert configContext.history.checkpoint == ('2024-01-01T00:00:15.000Z', 'u0015')
+
+
+def test_bisection_isolates_several_failed_requests():
+    configContext = ConfigContext(32)
+    session = BulkSession(reportInvalid=False)
+    events = makeEvents(32, bad=[0, 17, 18, 31])
+
+    runOutput(configContext, session, events)
+
+    assert session.tracked == [ event._matomoRequest for event in events if 'bad' not in event._matomoRequest ]
+    assert session.posts < 32
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the Matomo requests spool."""
+
+import json
+import os
+
+import requests
+
+from dspace_stats_collector.eventpipeline import Event
+from dspace_stats_collector.matomooutput import MatomoOutput
+from dspace_stats_collector.matomospool import MatomoSpool
+
+
+def requestsOf(n, first=0):
+    return [ ('?idsite=1&_id=%d' % i, '2024-01-01T00:00:%02d.000Z' % (i % 60), 'u%04d' % i) for i in range(first, first + n) ]
+
+
+def readAll(spool, batchSize=1000):
+    return [ request for (batch, position) in spool.read(batchSize) for request in batch ]
+
+
+def test_torn_last_record_is_truncated(tmp_path):
+    spool = MatomoSpool(str(tmp_path))
+    spool.append(requestsOf(3))
+    spool.close()
+
+    # a crash while appending leaves a partial line at the end of the segment
+    segment = os.path.join(str(tmp_path), 'segment-000000000000.log')
+    with open(segment, 'ab') as f:
+        f.write(b'["?idsite=1&_id=3", "2024-01')
+    size = os.path.getsize(segment)
+
+    spool = MatomoSpool(str(tmp_path))
+    assert os.path.getsize(segment) < size
+    assert readAll(spool) == requestsOf(3)
+
+    # appending after the truncation keeps the spool readable
+    spool.append(requestsOf(2, first=3))
+    assert readAll(spool) == requestsOf(5)
+    spool.close()
+
+
+def test_segments_roll_over_and_are_deleted_once_acknowledged(tmp_path):
+    spool = MatomoSpool(str(tmp_path), segmentMaxBytes=200)
+    positions = [ spool.append(requestsOf(3, first=3 * i)) for i in range(4) ]
+
+    segments = sorted( name for name in os.listdir(str(tmp_path)) if name.startswith('segment-') )
+    assert len(segments) > 1
+
+    spool.acknowledge(positions[-2])
+    remaining = sorted( name for name in os.listdir(str(tmp_path)) if name.startswith('segment-') )
+    assert remaining == [ name for name in segments if int(name[8:20]) >= positions[-2][0] ]
+
+    # only the requests after the acknowledged position are read again, also after reopening the spool
+    assert readAll(spool) == requestsOf(3, first=9)
+    spool.close()
+    assert readAll(MatomoSpool(str(tmp_path), segmentMaxBytes=200)) == requestsOf(3, first=9)
+
+
+def test_is_empty_after_full_drain(tmp_path):
+    spool = MatomoSpool(str(tmp_path))
+    assert spool.isEmpty()
+
+    spool.append(requestsOf(7))
+    assert not spool.isEmpty()
+
+    for (batch, position) in spool.read(3):
+        spool.acknowledge(position)
+    assert spool.isEmpty()
+    spool.close()
+
+    assert MatomoSpool(str(tmp_path)).isEmpty()
+
+
+class History:
+
+    def __init__(self):
+        self.checkpoint = None
+
+    def save_last_tracked_timestamp(self, timestamp, uid=None):
+        self.checkpoint = (timestamp, uid)
+
+    def get_last_tracked_timestamp(self):
+        return self.checkpoint[0] if self.checkpoint is not None else None
+
+
+class ConfigContext:
+
+    solrUniqueKey = 'uid'
+    solrQueryInitialTimestamp = '2024-01-01T00:00:00.000Z'
+
+    def __init__(self, spoolDir, history):
+        self.matomoSpoolDir = spoolDir
+        self.history = history
+
+    def getMatomoUrl(self):
+        return 'http://matomo.invalid/matomo.php'
+
+    def getMatomoOutputSize(self):
+        return 4
+
+    def getMatomoConcurrentRequests(self):
+        return 1
+
+    def getMatomoTokenAuth(self):
+        return 'token'
+
+
+class Response:
+
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+
+    def raise_for_status(self):
+        pass
+
+
+class Session:
+
+    """ Fake matomo bulk tracking endpoint, records the requests received """
+    def __init__(self, online, received):
+        self.online = online
+        self.received = received
+
+    def post(self, url, data):
+        if not self.online:
+            raise requests.exceptions.ConnectionError('matomo is offline')
+        self.received.extend(json.loads(data)['requests'])
+        return Response(json.dumps({'status': 'success', 'tracked': 0, 'invalid': 0}))
+
+    def close(self):
+        pass
+
+
+def makeEvents(n, first=0):
+    events = []
+    for (i, (request, time, uid)) in enumerate(requestsOf(n, first)):
+        event = Event()
+        event._src = {'time': time, 'uid': uid}
+        event._matomoRequest = request
+        event.is_robot = (i % 5 == 4)
+        events.append(event)
+    return events
+
+
+def runOutput(spoolDir, history, events, online, received):
+    output = MatomoOutput(ConfigContext(spoolDir, history))
+    output._sender._session.close()
+    output._sender._session = Session(online, received)
+    output.run(iter(events))
+
+
+def test_offline_run_is_spooled_and_drained_in_next_run(tmp_path):
+    spoolDir = str(tmp_path / 'spool')
+    history = History()
+    received = []
+
+    # matomo is offline, every event is spooled and the checkpoint advances anyway
+    firstRun = makeEvents(10)
+    runOutput(spoolDir, history, firstRun, False, received)
+    assert received == []
+    assert history.checkpoint == ('2024-01-01T00:00:09.000Z', 'u0009')
+    assert not MatomoSpool(spoolDir).isEmpty()
+
+    # next run sends the spooled events first, then the new ones
+    secondRun = makeEvents(6, first=10)
+    runOutput(spoolDir, history, secondRun, True, received)
+
+    expected = [ event._matomoRequest for event in firstRun + secondRun if not event.is_robot ]
+    assert received == expected
+    assert MatomoSpool(spoolDir).isEmpty()
+
+    # nothing is sent twice
+    runOutput(spoolDir, history, [], True, received)
+    assert received == expected
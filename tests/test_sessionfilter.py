@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the ip anonymization of the session filter."""
+
+from datetime import datetime
+
+from dspace_stats_collector.eventpipeline import Event, EventBatch
+from dspace_stats_collector.sessionfilter import SimpleHashSessionFilter
+
+
+class ConfigContext:
+
+    def __init__(self, mask):
+        self.anonymize_ip_mask = mask
+
+
+# (mask, ip, anonymized ip) as returned by the anonymizeip package (1.0.0) used before
+ANONYMIZED_IPS = [
+    ('255.255.255.0', '192.168.123.45', '192.168.123.0'),
+    ('255.255.255.0', '10.0.0.1', '10.0.0.0'),
+    ('255.255.255.0', '1.2.3.4:8080', '1.2.3.0'),
+    ('255.255.255.0', '2001:db8:85a3:1234:5678:8a2e:370:7334', '2001:db8:85a3:1234::'),
+    ('255.255.255.0', '::1', '::'),
+    ('255.255.255.0', '::ffff:192.0.2.128', '::'),
+    ('255.255.255.0', 'fe80::1%eth0', 'fe80::'),
+    ('255.255.255.0', 'garbage', '0.0.0.0'),
+    ('255.255.255.0', '', '0.0.0.0'),
+    ('255.255.255.0', '300.1.1.1', '0.0.0.0'),
+    ('255.255.0.0', '192.168.123.45', '192.168.0.0'),
+    ('255.255.0.0', '1.2.3.4:8080', '1.2.0.0'),
+    ('255.0.255.0', '192.168.123.45', '192.0.123.0'),
+    ('255.0.255.0', '2001:db8:85a3:1234:5678:8a2e:370:7334', '2001:db8:85a3:1234::'),
+    # invalid ipv4 masks anonymize every ipv4 address as 0.0.0.0, ipv6 addresses use their own mask
+    ('0.0.0.0', '192.168.123.45', '0.0.0.0'),
+    ('0.0.0.0', '1.2.3.4:8080', '0.0.0.0'),
+    ('0.0.0.0', '2001:db8:85a3:1234:5678:8a2e:370:7334', '2001:db8:85a3:1234::'),
+    ('nonsense', '10.0.0.1', '0.0.0.0'),
+    ('nonsense', '::1', '::'),
+]
+
+
+def test_anonymized_ips_match_anonymizeip():
+    for (mask, ip, anonymized) in ANONYMIZED_IPS:
+        assert SimpleHashSessionFilter(ConfigContext(mask))._anonymizeIp(ip) == anonymized, (mask, ip)
+
+
+def makeDocs():
+    # every ip twice, the second time it is anonymized from the memo
+    return [ {'ip': ip, 'userAgent': 'Mozilla/5.0'} for _ in range(2) for (mask, ip, anonymized) in ANONYMIZED_IPS if mask == '255.255.255.0' ]
+
+
+def test_event_and_batch_modes_anonymize_ips():
+    expected = [ anonymized for _ in range(2) for (mask, ip, anonymized) in ANONYMIZED_IPS if mask == '255.255.255.0' ]
+    time = datetime(2024, 1, 1, 12, 0, 0)
+
+    events = []
+    for (i, doc) in enumerate(makeDocs()):
+        event = Event()
+        event._id = i
+        event._time = time
+        event._src = doc
+        events.append(event)
+    events = list(SimpleHashSessionFilter(ConfigContext('255.255.255.0')).run(iter(events)))
+
+    batch = EventBatch(0, makeDocs())
+    batch.times = [time] * len(batch)
+    batch = next(SimpleHashSessionFilter(ConfigContext('255.255.255.0')).runBatches(iter([batch])))
+
+    assert [ event._src['ip'] for event in events ] == expected
+    assert batch.column('ip') == expected
+
+    # sessions are computed from the raw ip, before anonymizing it
+    assert [ event._sess['srcString'] for event in events ] == [ sess['srcString'] for sess in batch.sess ]
+    assert events[0]._sess['srcString'] == '2024-01-01#192.168.123.45#Mozilla/5.0'
+
+
+def test_full_mask_keeps_ips():
+    event = Event()
+    event._id = 0
+    event._time = datetime(2024, 1, 1, 12, 0, 0)
+    event._src = {'ip': '192.168.123.45', 'userAgent': None}
+
+    event = next(SimpleHashSessionFilter(ConfigContext('255.255.255.255')).run(iter([event])))
+    assert event._src['ip'] == '192.168.123.45'
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the solr statistics input."""
+
+import json
+import re
+
+from dspace_stats_collector.solrinput import SolrStatisticsInput, SolrTimestampCursor
+
+
+class ConfigContext:
+
+    solrQueryRows = 10
+    maxEventsToSend = None
+    solrQueryInitialTimestamp = '2024-01-01T00:00:09.123Z'
+    solrQueryUntilDate = '2024-01-01T06:00:09.123Z'
+    solrStatsCoreURL = 'http://solr.invalid/solr/statistics'
+    solrQueryInitialUid = None
+    solrPagingMode = 'timestamp'
+    solrUniqueKey = 'uid'
+    solrAdaptiveRows = False
+    solrMaxQueriesPerSecond = 0
+    solrQueriesBurst = 1
+    solrQTimeThresholdMillis = 0
+    solrMaxBackoffSeconds = 60
+    solrFetchBufferPages = 2
+
+
+class FacetSolr:
+
+    """ Fake solr answering range facet queries with the given [bucketStart, count, ...] list """
+    def __init__(self, counts):
+        self.counts = counts
+
+    def _select(self, params):
+        return json.dumps({
+            'responseHeader': {'status': 0, 'QTime': 1},
+            'response': {'numFound': sum(self.counts[1::2]), 'start': 0, 'docs': []},
+            'facet_counts': {'facet_ranges': {'time': {'counts': self.counts}}}
+        })
+
+
+def hourlyCounts(counts):
+    # buckets start at facet.range.start, so they keep its milliseconds
+    return [ value for (hour, count) in enumerate(counts) for value in ('2024-01-01T%02d:00:09.123Z' % hour, count) ]
+
+
+def makeInput():
+    return SolrStatisticsInput(ConfigContext())
+
+
+def test_split_time_range_with_millisecond_buckets():
+    solrInput = makeInput()
+    solr = FacetSolr(hourlyCounts([10, 10, 10, 10, 10, 10]))
+
+    boundaries = solrInput._splitTimeRange(solr, solrInput._baseQuery(), 3)
+
+    assert boundaries == [ '2024-01-01T00:00:09.123Z', '2024-01-01T02:00:09.123000Z', '2024-01-01T04:00:09.123000Z', '2024-01-01T06:00:09.123Z' ]
+
+
+def test_split_time_range_falls_back_to_a_single_shard():
+    solrInput = makeInput()
+    solr = FacetSolr(['not a timestamp', 10, 'neither', 10])
+
+    assert solrInput._splitTimeRange(solr, solrInput._baseQuery(), 2) == [ '2024-01-01T00:00:09.123Z', '2024-01-01T06:00:09.123Z' ]
+
+
+def test_sharded_fetch_returns_every_event_in_order():
+    times = [ '2024-01-01T%02d:%02d:00.000Z' % (hour, minute) for hour in range(6) for minute in range(0, 60, 5) ]
+    docs = [ {'uid': 'u%04d' % i, 'time': time} for (i, time) in enumerate(times) ]
+
+    def fetch(solr, query, initialTimestamp, initialUid, untilDate, limit):
+        # one page of up to 5 docs per call, over (initialTimestamp, untilDate]
+        shard = [ doc for doc in docs if initialTimestamp[:23] < doc['time'][:23] <= untilDate[:23] ]
+        return iter([ shard[i:i + 5] for i in range(0, len(shard), 5) ])
+
+    solrInput = makeInput()
+    solrInput._fetch = fetch
+    solrInput._newSolr = lambda: None
+    solr = FacetSolr(hourlyCounts([12, 12, 12, 12, 12, 12]))
+
+    pages = list(solrInput._fetchSharded(solr, solrInput._baseQuery(), 3))
+
+    assert [ doc for page in pages for doc in page ] == [ doc for doc in docs if doc['time'] > '2024-01-01T00:00:09.123Z' ]
+
+
+class CursorSolr:
+
+    """ Fake solr answering checkpoint queries with cursorMark paging, sorted by time and uid """
+    def __init__(self, docs):
+        self.docs = sorted(docs, key=lambda doc: (doc['time'], doc['uid']))
+        self.requests = 0
+
+    def _select(self, params):
+        self.requests += 1
+        m = re.search(r'time:\{"([^"]+)" TO \*\](?: OR \(time:"([^"]+)" AND uid:\{"([^"]+)" TO \*\]\))?', params['q'])
+        (after, sameTime, afterUid) = m.groups()
+        docs = [ doc for doc in self.docs if doc['time'] > after or (doc['time'] == sameTime and doc['uid'] > afterUid) ]
+
+        if params['cursorMark'] != '*':
+            mark = tuple(json.loads(params['cursorMark']))
+            docs = [ doc for doc in docs if (doc['time'], doc['uid']) > mark ]
+
+        page = docs[:int(params['rows'])]
+        nextCursorMark = json.dumps([page[-1]['time'], page[-1]['uid']]) if page else params['cursorMark']
+        return json.dumps({
+            'responseHeader': {'status': 0, 'QTime': 1},
+            'response': {'numFound': len(docs), 'start': 0, 'docs': page},
+            'nextCursorMark': nextCursorMark
+        })
+
+
+def sameTimeDocs():
+    # groups of 7 events sharing the same timestamp
+    return [ {'uid': 'u%04d' % i, 'time': '2024-01-01T00:%02d:00.000Z' % (i // 7)} for i in range(35) ]
+
+
+def test_cursor_mark_resumes_inside_events_sharing_a_timestamp():
+    docs = sameTimeDocs()
+    solr = CursorSolr(docs)
+    cursor = SolrTimestampCursor(solr, {'q': '*', 'start': 0}, uniqueKey='uid')
+
+    # the checkpoint is the fourth event of the second group
+    pages = list(cursor.fetchWithCursorMark(rows=5, initialTimestamp='2024-01-01T00:01:00.000Z', initialUid='u0010'))
+
+    assert [ doc for page in pages for doc in page ] == docs[11:]
+    assert max( len(page) for page in pages ) == 5
+
+
+def test_cursor_mark_resume_continues_after_the_last_event_of_a_run():
+    docs = sameTimeDocs()
+    cursor = SolrTimestampCursor(CursorSolr(docs), {'q': '*', 'start': 0}, uniqueKey='uid')
+
+    # a first run limited to 12 events, the next one resumes from its (time, uid) checkpoint
+    firstRun = [ doc for page in cursor.fetchWithCursorMark(rows=5, limit=12, initialTimestamp='2023-12-31T00:00:00.000Z') for doc in page ]
+    (time, uid) = (firstRun[-1]['time'], firstRun[-1]['uid'])
+    nextRun = [ doc for page in cursor.fetchWithCursorMark(rows=5, initialTimestamp=time, initialUid=uid) for doc in page ]
+
+    assert firstRun == docs[:12]
+    assert nextRun == docs[12:]
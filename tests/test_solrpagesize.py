@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the adaptive size of solr pages."""
+
+from dspace_stats_collector.solrpagesize import AdaptivePageSize
+
+
+def observeRequests(pageSize, requests, qtimeMillis=50, millisPerDoc=0.5, bytesPerDoc=1000):
+    """ Simulates full pages whose cost is qtimeMillis plus millisPerDoc per doc, returns the rows of each request """
+    rows = []
+    for _ in range(requests):
+        rows.append(pageSize.rows)
+        n = pageSize.rows
+        pageSize.observe(n, n, qtimeMillis + millisPerDoc * n, qtimeMillis, bytesPerDoc * n)
+    return rows
+
+
+def test_rows_converge_to_target_time():
+    pageSize = AdaptivePageSize(100, minRows=10, maxRows=100000, targetMillis=1000)
+    rows = observeRequests(pageSize, 20)
+
+    # (1000 - 50) / 0.5 docs fit in the target time
+    assert rows[-1] == 1900
+    # the page size at most doubles from one request to the next
+    assert all( b <= 2 * a for (a, b) in zip(rows, rows[1:]) )
+
+
+def test_rows_shrink_when_requests_get_slower():
+    pageSize = AdaptivePageSize(4000, minRows=10, maxRows=100000, targetMillis=1000)
+    rows = observeRequests(pageSize, 20, millisPerDoc=2.0)
+
+    assert rows[1] == 2000
+    assert rows[-1] == 475
+
+
+def test_rows_stay_within_bounds():
+    fast = AdaptivePageSize(500, minRows=100, maxRows=3000, targetMillis=1000)
+    assert observeRequests(fast, 10, millisPerDoc=0.01)[-1] == 3000
+
+    slow = AdaptivePageSize(500, minRows=100, maxRows=3000, targetMillis=1000)
+    assert observeRequests(slow, 10, qtimeMillis=2000, millisPerDoc=5.0)[-1] == 100
+
+
+def test_rows_are_limited_by_page_bytes():
+    pageSize = AdaptivePageSize(100, minRows=10, maxRows=100000, targetMillis=1000, maxPageBytes=1024 * 1024)
+    rows = observeRequests(pageSize, 20, bytesPerDoc=2048)
+
+    assert rows[-1] == 512
+
+
+def test_short_pages_are_ignored():
+    pageSize = AdaptivePageSize(1000, minRows=10, maxRows=100000, targetMillis=1000)
+
+    # the end of the events, a few docs in a slow request
+    pageSize.observe(1000, 3, 5000, 10, 3000)
+    pageSize.observe(1000, 0, 5000, 10, 0)
+
+    assert pageSize.rows == 1000
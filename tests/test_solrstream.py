@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the streaming parser of Solr responses."""
+
+import json
+import random
+
+from dspace_stats_collector.solrstream import SolrStreamingResponse
+
+
+def solrBody(numDocs):
+    docs = []
+    for i in range(numDocs):
+        docs.append({
+            'id': str(1000 + i),
+            'uid': 'u%04d' % i,
+            'time': '2024-01-01T00:00:%02d.000Z' % (i % 60),
+            'type': i % 3,
+            'owningItem': [ 12345 + i, -7 ],
+            'score': 1.5e3 + i,
+            'isBot': i % 2 == 0,
+            'referrer': None,
+            'userAgent': 'Mozilla/5.0 (Linux; Android 10) «ñandú» 漢字 😀 \\"quoted\\" %d' % i
+        })
+
+    # nextCursorMark comes after the response, and the response ends with a number
+    body = {
+        'responseHeader': {'status': 0, 'QTime': 17, 'params': {'q': 'time:[* TO *]', 'rows': '50'}},
+        'response': {'start': 0, 'docs': docs, 'numFound': 123456789},
+        'nextCursorMark': 'AoJ4+2024-01-01T00:00:49.000Z!u0049',
+        'elapsed': 42
+    }
+    return json.dumps(body, ensure_ascii=False).encode('utf-8')
+
+
+def splitAt(data, offsets):
+    offsets = [0] + sorted(offsets) + [len(data)]
+    return [ data[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1) ]
+
+
+def parse(chunks, size=7):
+    response = SolrStreamingResponse(chunks)
+    docs = [ doc for chunk in response.chunks(size) for doc in chunk ]
+    return (docs, response.header)
+
+
+def expected(data):
+    body = json.loads(data.decode('utf-8'))
+    docs = body['response'].pop('docs')
+    return (docs, body)
+
+
+def test_random_chunk_splits_match_json_loads():
+    data = solrBody(50)
+    rng = random.Random(20240101)
+
+    for _ in range(200):
+        offsets = rng.sample(range(1, len(data)), rng.randint(1, 60))
+        assert parse(splitAt(data, offsets)) == expected(data)
+
+
+def test_every_single_split_matches_json_loads():
+    # every byte boundary, including inside multibyte characters and numbers
+    data = solrBody(2)
+
+    for offset in range(1, len(data)):
+        assert parse(splitAt(data, [offset])) == expected(data)
+
+
+def test_byte_by_byte_and_whole_body():
+    data = solrBody(5)
+
+    assert parse([ data[i:i + 1] for i in range(len(data)) ]) == expected(data)
+    assert parse([data]) == expected(data)
+
+
+def test_docs_are_handed_out_in_chunks():
+    response = SolrStreamingResponse([solrBody(50)])
+    assert [ len(chunk) for chunk in response.chunks(20) ] == [20, 20, 10]
+    assert response.header['nextCursorMark'] == 'AoJ4+2024-01-01T00:00:49.000Z!u0049'